@@ -7,30 +7,45 @@ Supports both XML upload and Folio Fiscal data input methods.
 
 import asyncio
 import base64
+import binascii
 import hashlib
 import logging
 import os
-import tempfile
+import random
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 from enum import Enum
 from pathlib import Path
 from typing import Optional, List
 
 import httpx
-from celery import group, chord
+import orjson
+import redis.asyncio
+from celery import group, chord, states
 from celery.result import AsyncResult, GroupResult
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from playwright.async_api import async_playwright
+from sqlalchemy import String, cast, func, insert, text, tuple_
 from sqlalchemy.orm import Session
-from twocaptcha import TwoCaptcha
 
-from celery_app import celery_app
-from database import get_db, init_db, SessionLocal
-from models import Verification, Batch, VerificationStatus, VerificationMethod
-from tasks import verify_folio_task, verify_xml_task, batch_complete_callback
+from celery_app import celery_app, REDIS_URL
+from database import get_db, init_db, stats_views_enabled, SessionLocal
+from job_store import RedisStore
+from models import Verification, Batch, VerificationStatus, VerificationMethod, utcnow
+from tasks import (
+    verify_folio_task,
+    verify_folio_chunk_task,
+    verify_xml_task,
+    job_completed_callback,
+    job_failed_callback,
+    batch_counters_key,
+    worker_heartbeat_key,
+    batch_complete_callback,
+    BATCH_CHUNK_SIZE,
+    TWOCAPTCHA_URL,
+)
 
 # Setup logging
 logging.basicConfig(
@@ -38,6 +53,8 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger("cfdi-verifier")
+# httpx logs every request URL at INFO, which includes the 2Captcha key on polls
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # Load environment variables
 load_dotenv(Path(__file__).parent / ".env")
@@ -46,19 +63,48 @@ app = FastAPI(
     title="CFDI Verifier API",
     description="API for verifying Mexican digital tax invoices (CFDI) against SAT",
     version="3.0.0",
+    default_response_class=ORJSONResponse,
 )
 
 
+# Largest batch /verify/folio/batch waits for in one request
+SYNC_BATCH_MAX_ITEMS = int(os.getenv("SYNC_BATCH_MAX_ITEMS", "50"))
+
+# Reuse a completed verification of the same CFDI for this long
+RESULT_CACHE_SECONDS = int(os.getenv("RESULT_CACHE_SECONDS", "600"))
+
+# How long the sync endpoints wait for their Celery task
+SYNC_VERIFY_TIMEOUT = int(os.getenv("SYNC_VERIFY_TIMEOUT", "300"))
+
+WEBHOOK_MAX_ATTEMPTS = 5
+
+
 @app.on_event("startup")
 async def startup_event():
-    """Initialize database on startup."""
+    """Initialize database and shared HTTP client on startup."""
     logger.info("Initializing database...")
     init_db()
     logger.info("Database initialized")
 
+    # Shared webhook client, keeps connections to callback hosts alive
+    app.state.http = httpx.AsyncClient(
+        timeout=30,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Close the shared HTTP client and Redis connections."""
+    await app.state.http.aclose()
+    await redis_client.aclose()
+
 
-# In-memory job storage (kept for backwards compatibility, DB is primary)
-jobs: dict[str, dict] = {}
+# Job and batch metadata shared by all API workers (DB is primary)
+redis_client = redis.asyncio.from_url(REDIS_URL, decode_responses=True)
+jobs = RedisStore(redis_client, "job")
+batches = RedisStore(redis_client, "batch")
 
 
 class JobStatus(str, Enum):
@@ -118,10 +164,14 @@ class BatchItem(BaseModel):
     re: str  # RFC Emisor
     rr: str  # RFC Receptor
 
+    # Up to 500 per batch: bound the strings and skip per-instance extras
+    model_config = {"str_max_length": 64, "frozen": True, "extra": "ignore"}
+
 
 class BatchRequest(BaseModel):
-    items: List[BatchItem]
+    items: list[BatchItem]
     webhook_url: Optional[str] = None
+    per_item_webhooks: bool = False  # Also POST each item's result, not just the batch summary
 
     model_config = {
         "json_schema_extra": {
@@ -163,430 +213,274 @@ class JobResult(BaseModel):
     error: Optional[str] = None
 
 
-# ---------- CAPTCHA Solving ----------
+# ---------- Request Coalescing ----------
 
-async def solve_captcha(image_bytes: bytes) -> str:
-    """Solve CAPTCHA using 2Captcha service."""
-    api_key = os.getenv("TWOCAPTCHA_API_KEY")
-    if not api_key:
-        raise ValueError("TWOCAPTCHA_API_KEY not set")
+# Verifications in progress, concurrent duplicates await the same future
+_inflight: dict[tuple, asyncio.Future] = {}
 
-    solver = TwoCaptcha(api_key)
-    base64_image = base64.standard_b64encode(image_bytes).decode("utf-8")
 
-    loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(None, lambda: solver.normal(base64_image))
-    return result["code"]
+async def coalesce(key: tuple, factory):
+    """Run factory() once per key at a time; concurrent callers share its result."""
+    fut = _inflight.get(key)
+    if fut is not None:
+        logger.info(f"Joining in-flight verification for {key}")
+        return await asyncio.shield(fut)
+
+    fut = asyncio.get_event_loop().create_future()
+    # Mark the exception retrieved even if nobody else joined
+    fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+    _inflight[key] = fut
+    try:
+        result = await factory()
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        raise
+    else:
+        fut.set_result(result)
+        return result
+    finally:
+        _inflight.pop(key, None)
+
+
+def folio_key(folio_fiscal: str, rfc_emisor: str, rfc_receptor: str) -> str:
+    return f"{folio_fiscal}:{rfc_emisor}:{rfc_receptor}".upper()
+
+
+def folio_result_key(folio: str) -> str:
+    return f"cfdi:folio_result:{folio}"
+
+
+def folio_task_key(folio: str) -> str:
+    return f"cfdi:folio_task:{folio}"
+
+
+def recent_folio_result(folio_fiscal: str, rfc_emisor: str, rfc_receptor: str) -> Optional[dict]:
+    """Return the SAT response of a recent completed verification of the same CFDI."""
+    cutoff = utcnow() - timedelta(seconds=RESULT_CACHE_SECONDS)
+    db = SessionLocal()
+    try:
+        verification = db.query(Verification).filter(
+            Verification.folio_fiscal == folio_fiscal,
+            Verification.rfc_emisor == rfc_emisor,
+            Verification.rfc_receptor == rfc_receptor,
+            Verification.status == VerificationStatus.COMPLETED,
+            Verification.completed_at >= cutoff,
+        ).order_by(Verification.completed_at.desc()).first()
+        return verification.sat_response if verification else None
+    except Exception as e:
+        logger.error(f"DB error looking up recent result: {e}")
+        return None
+    finally:
+        db.close()
 
 
 # ---------- Verification by Folio Fiscal ----------
 
-async def verify_by_folio(
+async def verify_by_folio_queued(
     folio_fiscal: str,
     rfc_emisor: str,
     rfc_receptor: str,
-    total: Optional[str] = None,
     max_retries: int = 3
 ) -> dict:
-    """Verify CFDI by Folio Fiscal (UUID, RFC emisor, RFC receptor)."""
-    logger.info(f"Starting verification for folio: {folio_fiscal}")
-    logger.info(f"RFC Emisor: {rfc_emisor}, RFC Receptor: {rfc_receptor}")
-
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(headless=True)
-        page = await browser.new_page()
-
-        for attempt in range(max_retries):
-            try:
-                logger.info(f"Attempt {attempt + 1}/{max_retries}")
-                await page.goto("https://verificacfdi.facturaelectronica.sat.gob.mx/")
-                await page.wait_for_load_state("networkidle")
-                await page.wait_for_timeout(500)
-
-                # Fill form (already on Folio Fiscal tab by default)
-                logger.info("Filling form fields...")
-                await page.locator("#ctl00_MainContent_TxtUUID").fill(folio_fiscal)
-                await page.locator("#ctl00_MainContent_TxtRfcEmisor").fill(rfc_emisor)
-                await page.locator("#ctl00_MainContent_TxtRfcReceptor").fill(rfc_receptor)
-
-                # Solve CAPTCHA
-                logger.info("Solving CAPTCHA...")
-                captcha_img = page.locator("#ctl00_MainContent_ImgCaptcha")
-                captcha_bytes = await captcha_img.screenshot()
-                captcha_text = await solve_captcha(captcha_bytes)
-                logger.info(f"CAPTCHA solution: {captcha_text}")
-
-                await page.locator("#ctl00_MainContent_TxtCaptchaNumbers").fill(captcha_text)
-                logger.info("Submitting form...")
-                await page.get_by_role("button", name="Verificar CFDI").click()
-                await page.wait_for_timeout(2000)
-
-                page_content = await page.content()
-                logger.info(f"Page contains 'Vigente': {'Vigente' in page_content}")
-                logger.info(f"Page contains 'Cancelado': {'Cancelado' in page_content}")
-
-                if "Vigente" in page_content or "Cancelado" in page_content:
-                    logger.info("CFDI found, extracting results...")
-                    results = await extract_results(page)
-                    await browser.close()
-                    return results
-                elif "incorrecto" in page_content.lower():
-                    logger.warning(f"CAPTCHA incorrect, retrying...")
-                    if attempt < max_retries - 1:
-                        await page.reload()
-                        continue
-                else:
-                    logger.info("Extracting results (unknown status)...")
-                    results = await extract_results(page)
-                    await browser.close()
-                    return results
-
-            except Exception as e:
-                if attempt < max_retries - 1:
-                    continue
-                raise
-
-        await browser.close()
-        raise Exception(f"Failed after {max_retries} attempts")
-
+    """
+    Verify CFDI by Folio Fiscal (UUID, RFC emisor, RFC receptor) on a Celery worker.
 
-# ---------- Verification by XML ----------
+    Served from a verification completed in the last RESULT_CACHE_SECONDS if
+    there is one; concurrent requests for the same CFDI share one task.
+    """
+    return await verify_folio_once(
+        folio_fiscal, rfc_emisor, rfc_receptor,
+        lambda: run_folio_task(folio_fiscal, rfc_emisor, rfc_receptor, max_retries),
+    )
 
-async def verify_by_xml(xml_content: str, max_retries: int = 3) -> dict:
-    """Verify CFDI by uploading XML file."""
 
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".xml", delete=False) as f:
-        f.write(xml_content)
-        xml_path = f.name
+async def run_folio_task(folio_fiscal: str, rfc_emisor: str, rfc_receptor: str, max_retries: int) -> dict:
+    """
+    Dispatch verify_folio_task, or wait for the one another API worker
+    already dispatched for the same CFDI.
+    """
+    key = folio_task_key(folio_key(folio_fiscal, rfc_emisor, rfc_receptor))
+    task_id = str(uuid.uuid4())
+    if not await redis_client.set(key, task_id, nx=True, ex=SYNC_VERIFY_TIMEOUT):
+        running_id = await redis_client.get(key)
+        if running_id:
+            logger.info(f"Joining queued verification {running_id} for folio: {folio_fiscal}")
+            return await wait_for_task(AsyncResult(running_id, app=celery_app))
 
     try:
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=True)
-            page = await browser.new_page()
-
-            for attempt in range(max_retries):
-                try:
-                    await page.goto("https://verificacfdi.facturaelectronica.sat.gob.mx/")
-                    await page.wait_for_load_state("networkidle")
-
-                    await page.get_by_role("radio", name="Consulta por archivo XML").click()
-                    await page.wait_for_timeout(500)
-
-                    async with page.expect_file_chooser() as fc_info:
-                        await page.get_by_text("Buscar").click()
-                    file_chooser = await fc_info.value
-                    await file_chooser.set_files(xml_path)
-                    await page.wait_for_timeout(500)
-
-                    captcha_img = page.locator("#ctl00_MainContent_ImgCaptchaXml")
-                    captcha_bytes = await captcha_img.screenshot()
-                    captcha_text = await solve_captcha(captcha_bytes)
-
-                    await page.locator("#ctl00_MainContent_TxtCaptchaNumbersXml").fill(captcha_text)
-                    await page.get_by_role("button", name="Verificar CFDI").click()
-                    await page.wait_for_timeout(2000)
-
-                    page_content = await page.content()
-
-                    if "Vigente" in page_content or "CFDI válido" in page_content:
-                        results = await extract_results(page)
-                        await browser.close()
-                        return results
-                    elif "incorrecto" in page_content.lower():
-                        if attempt < max_retries - 1:
-                            await page.reload()
-                            continue
-                    else:
-                        results = await extract_results(page)
-                        await browser.close()
-                        return results
-
-                except Exception as e:
-                    if attempt < max_retries - 1:
-                        continue
-                    raise
-
-            await browser.close()
-            raise Exception(f"Failed after {max_retries} attempts")
-
+        return await wait_for_task(verify_folio_task.apply_async(
+            kwargs={
+                "folio_fiscal": folio_fiscal,
+                "rfc_emisor": rfc_emisor,
+                "rfc_receptor": rfc_receptor,
+                "max_captcha_retries": max_retries,
+            },
+            task_id=task_id,
+        ))
     finally:
-        Path(xml_path).unlink(missing_ok=True)
-
-
-async def extract_results(page) -> dict:
-    """Extract verification results from SAT page."""
-
-    results = {
-        "valid": False,
-        "message": "",
-        "folio_fiscal": "",
-        "rfc_emisor": "",
-        "nombre_emisor": "",
-        "rfc_receptor": "",
-        "nombre_receptor": "",
-        "fecha_expedicion": "",
-        "fecha_certificacion": "",
-        "pac_certificador": "",
-        "total": "",
-        "efecto": "",
-        "estado": "",
-        "estatus_cancelacion": "",
-        "fecha_cancelacion": "",
-    }
+        # Only clear our own marker; it may have expired and been taken over
+        if await redis_client.get(key) == task_id:
+            await redis_client.delete(key)
 
-    try:
-        page_content = await page.content()
-        logger.info("Extracting results from page...")
-
-        # Check validity - Vigente or Cancelado both mean the CFDI exists/existed
-        if "Vigente" in page_content:
-            results["valid"] = True
-            results["message"] = "CFDI vigente - válido y activo"
-        elif "Cancelado" in page_content:
-            results["valid"] = True  # It was valid, just cancelled
-            results["message"] = "CFDI cancelado"
-        else:
-            results["message"] = "CFDI no encontrado o inválido"
-
-        # Get all tables
-        tables = page.locator("table")
-        table_count = await tables.count()
-        logger.info(f"Found {table_count} tables")
-
-        # Parse each table row by row
-        all_rows = page.locator("table tr")
-        row_count = await all_rows.count()
-        logger.info(f"Found {row_count} total rows")
-
-        for i in range(row_count):
-            row = all_rows.nth(i)
-            cells = row.locator("td")
-            cell_count = await cells.count()
-
-            if cell_count == 0:
-                continue
-
-            # Get all cell texts
-            cell_texts = []
-            for j in range(cell_count):
-                text = (await cells.nth(j).inner_text()).strip()
-                cell_texts.append(text)
-
-            logger.info(f"Row {i}: {cell_texts}")
-
-            # Match patterns based on cell content
-            if cell_count >= 4:
-                # Emisor/Receptor row (RFC, Nombre, RFC, Nombre)
-                if cell_texts[0] and len(cell_texts[0]) >= 12 and len(cell_texts[0]) <= 13:
-                    if not cell_texts[0].startswith("RFC") and not results["rfc_emisor"]:
-                        results["rfc_emisor"] = cell_texts[0]
-                        results["nombre_emisor"] = cell_texts[1]
-                        results["rfc_receptor"] = cell_texts[2]
-                        results["nombre_receptor"] = cell_texts[3]
-                        logger.info(f"Found emisor/receptor: {cell_texts}")
-
-                # Folio/Fechas row
-                if "-" in cell_texts[0] and "T" in cell_texts[1]:
-                    results["folio_fiscal"] = cell_texts[0]
-                    results["fecha_expedicion"] = cell_texts[1]
-                    results["fecha_certificacion"] = cell_texts[2] if cell_count > 2 else ""
-                    results["pac_certificador"] = cell_texts[3] if cell_count > 3 else ""
-                    logger.info(f"Found folio/fechas: {cell_texts}")
-
-            if cell_count >= 3:
-                # Total/Efecto/Estado row
-                if cell_texts[0].startswith("$"):
-                    results["total"] = cell_texts[0]
-                    results["efecto"] = cell_texts[1]
-                    results["estado"] = cell_texts[2]
-                    logger.info(f"Found total/estado: {cell_texts}")
-
-            if cell_count >= 2:
-                # Cancelacion row
-                if "Cancelado" in cell_texts[0] and "T" in cell_texts[1]:
-                    results["estatus_cancelacion"] = cell_texts[0]
-                    results["fecha_cancelacion"] = cell_texts[1]
-                    logger.info(f"Found cancelacion: {cell_texts}")
-
-        logger.info(f"Final results: {results}")
 
-    except Exception as e:
-        logger.error(f"Error extracting results: {e}")
+async def verify_folio_once(folio_fiscal: str, rfc_emisor: str, rfc_receptor: str, run) -> dict:
+    """
+    Serve from a recent result or an in-flight run before calling run().
+    Recent results are shared between API workers through Redis, with the
+    DB as a fallback for verifications that finished elsewhere (jobs, batches).
+    """
+    result_key = folio_result_key(folio_key(folio_fiscal, rfc_emisor, rfc_receptor))
+    cached = await redis_client.get(result_key)
+    if cached is not None:
+        logger.info(f"Using cached result for folio: {folio_fiscal}")
+        return orjson.loads(cached)
 
-    return results
+    cached = await asyncio.to_thread(recent_folio_result, folio_fiscal, rfc_emisor, rfc_receptor)
+    if cached is not None:
+        logger.info(f"Using recent DB result for folio: {folio_fiscal}")
+        return cached
 
+    async def run_and_cache():
+        result = await run()
+        await redis_client.set(result_key, orjson.dumps(result), ex=RESULT_CACHE_SECONDS)
+        return result
 
-# ---------- Webhook ----------
+    return await coalesce((folio_fiscal, rfc_emisor, rfc_receptor), run_and_cache)
 
-async def send_webhook(webhook_url: str, job_id: str, job_data: dict):
-    """Send job result to webhook URL."""
-    try:
-        payload = {
-            "job_id": job_id,
-            "status": job_data["status"],
-            "created_at": job_data["created_at"],
-            "completed_at": job_data["completed_at"],
-            "result": job_data["result"],
-            "error": job_data["error"],
-        }
-        async with httpx.AsyncClient(timeout=30) as client:
-            response = await client.post(webhook_url, json=payload)
-            response.raise_for_status()
-    except Exception as e:
-        print(f"Webhook failed for job {job_id}: {e}")
 
+async def wait_for_task(async_result) -> dict:
+    """Wait for a Celery task's result in a thread, keeping the event loop free."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, lambda: async_result.get(timeout=SYNC_VERIFY_TIMEOUT))
 
-# ---------- Background Job Processing ----------
 
-async def process_folio_job(job_id: str, folio: str, rfc_e: str, rfc_r: str, total: str, webhook_url: Optional[str], max_retries: int):
-    """Background task for Folio verification."""
-    jobs[job_id]["status"] = JobStatus.PROCESSING
+# ---------- Verification by XML ----------
 
-    # Update DB status to processing
-    db = SessionLocal()
-    try:
-        db_verification = db.query(Verification).filter(Verification.job_id == job_id).first()
-        if db_verification:
-            db_verification.status = VerificationStatus.PROCESSING
-            db_verification.started_at = datetime.utcnow()
-            db.commit()
-    except Exception as e:
-        logger.error(f"DB error updating status to processing: {e}")
-    finally:
-        db.close()
+# Hash XML in slices so multi-MB payloads are never encoded whole
+XML_CHUNK_SIZE = 65536
 
-    try:
-        result = await verify_by_folio(folio, rfc_e, rfc_r, total, max_retries)
-        jobs[job_id]["status"] = JobStatus.COMPLETED
-        jobs[job_id]["result"] = result
-        jobs[job_id]["completed_at"] = datetime.utcnow().isoformat()
 
-        # Update DB with success
-        db = SessionLocal()
-        try:
-            db_verification = db.query(Verification).filter(Verification.job_id == job_id).first()
-            if db_verification:
-                db_verification.status = VerificationStatus.COMPLETED
-                db_verification.valid = result.get("valid", False)
-                db_verification.sat_response = result
-                db_verification.completed_at = datetime.utcnow()
-                db.commit()
-        except Exception as e:
-            logger.error(f"DB error saving result: {e}")
-        finally:
-            db.close()
+def xml_sha256(xml_content: str) -> str:
+    """SHA-256 of the UTF-8 encoded XML."""
+    digest = hashlib.sha256()
+    for i in range(0, len(xml_content), XML_CHUNK_SIZE):
+        digest.update(xml_content[i:i + XML_CHUNK_SIZE].encode("utf-8"))
+    return digest.hexdigest()
 
-    except Exception as e:
-        jobs[job_id]["status"] = JobStatus.FAILED
-        jobs[job_id]["error"] = str(e)
-        jobs[job_id]["completed_at"] = datetime.utcnow().isoformat()
 
-        # Update DB with failure
-        db = SessionLocal()
-        try:
-            db_verification = db.query(Verification).filter(Verification.job_id == job_id).first()
-            if db_verification:
-                db_verification.status = VerificationStatus.FAILED
-                db_verification.error_message = str(e)
-                db_verification.completed_at = datetime.utcnow()
-                db.commit()
-        except Exception as db_err:
-            logger.error(f"DB error saving failure: {db_err}")
-        finally:
-            db.close()
-
-    # Send webhook if configured
-    if webhook_url:
-        await send_webhook(webhook_url, job_id, jobs[job_id])
+def read_xml_request(request: VerifyXMLRequest) -> tuple[str, str]:
+    """
+    Return the request's XML text and its SHA-256.
 
-        # Update webhook_sent in DB
-        db = SessionLocal()
-        try:
-            db_verification = db.query(Verification).filter(Verification.job_id == job_id).first()
-            if db_verification:
-                db_verification.webhook_sent = True
-                db.commit()
-        except Exception as e:
-            logger.error(f"DB error updating webhook_sent: {e}")
-        finally:
-            db.close()
+    Raw xml_content is used as-is; xml_base64 is strictly decoded once and the
+    decoded bytes are hashed directly instead of re-encoding the text.
+    """
+    if request.xml_content:
+        return request.xml_content, xml_sha256(request.xml_content)
 
+    if not request.xml_base64:
+        raise HTTPException(status_code=400, detail="xml_content or xml_base64 required")
+
+    try:
+        xml_bytes = base64.b64decode(request.xml_base64, validate=True)
+        xml_content = xml_bytes.decode("utf-8")
+    except (binascii.Error, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="xml_base64 is not valid base64-encoded UTF-8")
 
-async def process_xml_job(job_id: str, xml_content: str, webhook_url: Optional[str], max_retries: int):
-    """Background task for XML verification."""
-    jobs[job_id]["status"] = JobStatus.PROCESSING
+    return xml_content, hashlib.sha256(xml_bytes).hexdigest()
 
-    # Update DB status to processing
+
+def recent_xml_result(xml_hash: str) -> Optional[dict]:
+    """Return the SAT response of a recent completed verification of the same XML."""
+    cutoff = utcnow() - timedelta(seconds=RESULT_CACHE_SECONDS)
     db = SessionLocal()
     try:
-        db_verification = db.query(Verification).filter(Verification.job_id == job_id).first()
-        if db_verification:
-            db_verification.status = VerificationStatus.PROCESSING
-            db_verification.started_at = datetime.utcnow()
-            db.commit()
+        verification = db.query(Verification).filter(
+            Verification.xml_hash == xml_hash,
+            Verification.status == VerificationStatus.COMPLETED,
+            Verification.completed_at >= cutoff,
+        ).order_by(Verification.completed_at.desc()).first()
+        return verification.sat_response if verification else None
     except Exception as e:
-        logger.error(f"DB error updating status to processing: {e}")
+        logger.error(f"DB error looking up recent XML result: {e}")
+        return None
     finally:
         db.close()
 
-    try:
-        result = await verify_by_xml(xml_content, max_retries)
-        jobs[job_id]["status"] = JobStatus.COMPLETED
-        jobs[job_id]["result"] = result
-        jobs[job_id]["completed_at"] = datetime.utcnow().isoformat()
 
-        # Update DB with success
-        db = SessionLocal()
+# ---------- Webhook ----------
+
+async def send_webhook(webhook_url: str, job_id: str, job_data: dict):
+    """Send job result to webhook URL, retrying with exponential backoff."""
+    payload = {
+        "job_id": job_id,
+        "status": job_data["status"],
+        "created_at": job_data["created_at"],
+        "completed_at": job_data["completed_at"],
+        "result": job_data["result"],
+        "error": job_data["error"],
+    }
+    body = orjson.dumps(payload)
+    for attempt in range(WEBHOOK_MAX_ATTEMPTS):
         try:
-            db_verification = db.query(Verification).filter(Verification.job_id == job_id).first()
-            if db_verification:
-                db_verification.status = VerificationStatus.COMPLETED
-                db_verification.valid = result.get("valid", False)
-                db_verification.sat_response = result
-                db_verification.folio_fiscal = result.get("folio_fiscal")
-                db_verification.rfc_emisor = result.get("rfc_emisor")
-                db_verification.rfc_receptor = result.get("rfc_receptor")
-                db_verification.completed_at = datetime.utcnow()
-                db.commit()
-        except Exception as e:
-            logger.error(f"DB error saving result: {e}")
-        finally:
-            db.close()
+            response = await app.state.http.post(
+                webhook_url, content=body, headers={"content-type": "application/json"}
+            )
+            if response.status_code < 500 and response.status_code != 429:
+                response.raise_for_status()
+                return
+            error = f"HTTP {response.status_code}"
+        except httpx.HTTPStatusError as e:
+            # Client errors won't succeed on retry
+            logger.error(f"Webhook rejected for job {job_id}: {e}")
+            return
+        except httpx.HTTPError as e:
+            error = str(e) or type(e).__name__
+
+        if attempt + 1 < WEBHOOK_MAX_ATTEMPTS:
+            delay = min(2 ** attempt + random.random(), 30)
+            logger.warning(f"Webhook attempt {attempt + 1} failed for job {job_id} ({error}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        else:
+            logger.error(f"Webhook failed for job {job_id} after {WEBHOOK_MAX_ATTEMPTS} attempts: {error}")
 
-    except Exception as e:
-        jobs[job_id]["status"] = JobStatus.FAILED
-        jobs[job_id]["error"] = str(e)
-        jobs[job_id]["completed_at"] = datetime.utcnow().isoformat()
 
-        # Update DB with failure
-        db = SessionLocal()
-        try:
-            db_verification = db.query(Verification).filter(Verification.job_id == job_id).first()
-            if db_verification:
-                db_verification.status = VerificationStatus.FAILED
-                db_verification.error_message = str(e)
-                db_verification.completed_at = datetime.utcnow()
-                db.commit()
-        except Exception as db_err:
-            logger.error(f"DB error saving failure: {db_err}")
-        finally:
-            db.close()
-
-    # Send webhook if configured
-    if webhook_url:
-        await send_webhook(webhook_url, job_id, jobs[job_id])
+# ---------- Async Jobs ----------
+
+def job_task_outcome(task_id: str) -> Optional[dict]:
+    """Job fields for the Celery task behind an async job, once it has started."""
+    async_result = AsyncResult(task_id, app=celery_app)
+    state = async_result.state
+    if state in (states.STARTED, states.RETRY):
+        return {"status": JobStatus.PROCESSING}
+    if state not in (states.SUCCESS, states.FAILURE):
+        return None
+
+    completed_at = (async_result.date_done or utcnow()).isoformat()
+    if state == states.SUCCESS:
+        return {"status": JobStatus.COMPLETED, "result": async_result.result, "completed_at": completed_at}
+    return {"status": JobStatus.FAILED, "error": str(async_result.result), "completed_at": completed_at}
 
-        # Update webhook_sent in DB
-        db = SessionLocal()
-        try:
-            db_verification = db.query(Verification).filter(Verification.job_id == job_id).first()
-            if db_verification:
-                db_verification.webhook_sent = True
-                db.commit()
-        except Exception as e:
-            logger.error(f"DB error updating webhook_sent: {e}")
-        finally:
-            db.close()
+
+# ---------- HTTP Caching ----------
+
+# Finished batches and verifications never change again
+TERMINAL_CACHE_CONTROL = "public, max-age=3600, immutable"
+
+
+def make_etag(*parts) -> str:
+    return '"' + hashlib.md5(":".join(map(str, parts)).encode()).hexdigest() + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether the client's If-None-Match already names this ETag."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in (tag.strip().removeprefix("W/") for tag in header.split(","))
 
 
 # ---------- API Endpoints ----------
@@ -633,17 +527,16 @@ async def verify_by_folio_sync(request: VerifyFolioRequest, db: Session = Depend
         rfc_receptor=request.rr,
         webhook_url=request.webhook_url,
         status=VerificationStatus.PROCESSING,
-        started_at=datetime.utcnow()
+        started_at=utcnow()
     )
     db.add(db_verification)
     db.commit()
 
     try:
-        result = await verify_by_folio(
+        result = await verify_by_folio_queued(
             request.id,
             request.re,
             request.rr,
-            request.tt,
             request.max_retries
         )
 
@@ -651,7 +544,7 @@ async def verify_by_folio_sync(request: VerifyFolioRequest, db: Session = Depend
         db_verification.status = VerificationStatus.COMPLETED
         db_verification.valid = result.get("valid", False)
         db_verification.sat_response = result
-        db_verification.completed_at = datetime.utcnow()
+        db_verification.completed_at = utcnow()
         db.commit()
 
         # Send webhook if configured
@@ -672,7 +565,7 @@ async def verify_by_folio_sync(request: VerifyFolioRequest, db: Session = Depend
         # Update DB record with error
         db_verification.status = VerificationStatus.FAILED
         db_verification.error_message = str(e)
-        db_verification.completed_at = datetime.utcnow()
+        db_verification.completed_at = utcnow()
         db.commit()
 
         if request.webhook_url:
@@ -690,7 +583,7 @@ async def verify_by_folio_sync(request: VerifyFolioRequest, db: Session = Depend
 
 
 @app.post("/verify/folio/async", response_model=JobResponse, tags=["Verification"])
-async def verify_by_folio_async(request: VerifyFolioRequest, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+async def verify_by_folio_async(request: VerifyFolioRequest, db: Session = Depends(get_db)):
     """
     Verify CFDI using Folio Fiscal data (async - returns job_id immediately).
 
@@ -698,7 +591,7 @@ async def verify_by_folio_async(request: VerifyFolioRequest, background_tasks: B
     Poll /jobs/{job_id} for results or provide webhook_url.
     """
     job_id = str(uuid.uuid4())
-    created_at = datetime.utcnow()
+    created_at = utcnow()
 
     # Create DB record
     db_verification = Verification(
@@ -713,25 +606,27 @@ async def verify_by_folio_async(request: VerifyFolioRequest, background_tasks: B
     db.add(db_verification)
     db.commit()
 
-    # Keep in-memory for backwards compatibility
-    jobs[job_id] = {
+    await jobs.create(job_id, {
         "status": JobStatus.PENDING,
         "created_at": created_at.isoformat(),
         "method": "folio",
         "result": None,
         "error": None,
         "completed_at": None,
-    }
-
-    background_tasks.add_task(
-        process_folio_job,
-        job_id,
-        request.id,
-        request.re,
-        request.rr,
-        request.tt,
-        request.webhook_url,
-        request.max_retries
+    })
+
+    # Runs on a Celery worker; the job id doubles as the task id for /jobs/{job_id}
+    callback_kwargs = {"job_id": job_id, "created_at": created_at.isoformat(), "webhook_url": request.webhook_url}
+    verify_folio_task.apply_async(
+        kwargs={
+            "folio_fiscal": request.id,
+            "rfc_emisor": request.re,
+            "rfc_receptor": request.rr,
+            "max_captcha_retries": request.max_retries,
+        },
+        task_id=job_id,
+        link=job_completed_callback.s(**callback_kwargs),
+        link_error=job_failed_callback.s(**callback_kwargs),
     )
 
     return JobResponse(
@@ -753,15 +648,9 @@ async def verify_by_xml_sync(request: VerifyXMLRequest, db: Session = Depends(ge
 
     Returns the verification result directly (takes ~20-40 seconds).
     """
-    xml_content = request.xml_content
-    if not xml_content and request.xml_base64:
-        xml_content = base64.b64decode(request.xml_base64).decode("utf-8")
-
-    if not xml_content:
-        raise HTTPException(status_code=400, detail="xml_content or xml_base64 required")
+    xml_content, xml_hash = read_xml_request(request)
 
     job_id = str(uuid.uuid4())
-    xml_hash = hashlib.sha256(xml_content.encode()).hexdigest()
 
     # Create DB record
     db_verification = Verification(
@@ -770,13 +659,20 @@ async def verify_by_xml_sync(request: VerifyXMLRequest, db: Session = Depends(ge
         xml_hash=xml_hash,
         webhook_url=request.webhook_url,
         status=VerificationStatus.PROCESSING,
-        started_at=datetime.utcnow()
+        started_at=utcnow()
     )
     db.add(db_verification)
     db.commit()
 
     try:
-        result = await verify_by_xml(xml_content, request.max_retries)
+        result = await asyncio.to_thread(recent_xml_result, xml_hash)
+        if result is not None:
+            logger.info(f"Using recent result for XML {xml_hash[:12]}")
+        else:
+            result = await wait_for_task(verify_xml_task.delay(
+                xml_content=xml_content,
+                max_captcha_retries=request.max_retries,
+            ))
 
         # Update DB record
         db_verification.status = VerificationStatus.COMPLETED
@@ -785,7 +681,7 @@ async def verify_by_xml_sync(request: VerifyXMLRequest, db: Session = Depends(ge
         db_verification.folio_fiscal = result.get("folio_fiscal")
         db_verification.rfc_emisor = result.get("rfc_emisor")
         db_verification.rfc_receptor = result.get("rfc_receptor")
-        db_verification.completed_at = datetime.utcnow()
+        db_verification.completed_at = utcnow()
         db.commit()
 
         if request.webhook_url:
@@ -804,7 +700,7 @@ async def verify_by_xml_sync(request: VerifyXMLRequest, db: Session = Depends(ge
     except Exception as e:
         db_verification.status = VerificationStatus.FAILED
         db_verification.error_message = str(e)
-        db_verification.completed_at = datetime.utcnow()
+        db_verification.completed_at = utcnow()
         db.commit()
 
         if request.webhook_url:
@@ -827,40 +723,89 @@ async def verify_by_xml_async(request: VerifyXMLRequest, background_tasks: Backg
     Verify CFDI by uploading XML content (async - returns job_id immediately).
 
     Use this for batch processing or when you can't hold the connection.
+    An XML verified in the last RESULT_CACHE_SECONDS comes back already completed.
     """
-    xml_content = request.xml_content
-    if not xml_content and request.xml_base64:
-        xml_content = base64.b64decode(request.xml_base64).decode("utf-8")
-
-    if not xml_content:
-        raise HTTPException(status_code=400, detail="xml_content or xml_base64 required")
+    xml_content, xml_hash = read_xml_request(request)
 
     job_id = str(uuid.uuid4())
-    jobs[job_id] = {
+    created_at = utcnow().isoformat()
+    result = await asyncio.to_thread(recent_xml_result, xml_hash)
+
+    if result is not None:
+        logger.info(f"Using recent result for XML {xml_hash[:12]}")
+        completed_at = utcnow()
+        await asyncio.to_thread(
+            save_xml_job, job_id, xml_hash, request.webhook_url,
+            status=VerificationStatus.COMPLETED,
+            valid=result.get("valid", False),
+            sat_response=result,
+            folio_fiscal=result.get("folio_fiscal"),
+            rfc_emisor=result.get("rfc_emisor"),
+            rfc_receptor=result.get("rfc_receptor"),
+            completed_at=completed_at,
+        )
+        job = {
+            "status": JobStatus.COMPLETED,
+            "created_at": created_at,
+            "method": "xml",
+            "result": result,
+            "error": None,
+            "completed_at": completed_at.isoformat(),
+        }
+        await jobs.create(job_id, job)
+        if request.webhook_url:
+            background_tasks.add_task(send_webhook, request.webhook_url, job_id, job)
+        return JobResponse(
+            job_id=job_id,
+            status=JobStatus.COMPLETED,
+            created_at=created_at,
+            message="Recently verified XML. Result available at /jobs/{job_id}."
+        )
+
+    # The worker's callbacks fill in this row, keyed by the job id
+    await asyncio.to_thread(save_xml_job, job_id, xml_hash, request.webhook_url,
+                            status=VerificationStatus.PENDING)
+    await jobs.create(job_id, {
         "status": JobStatus.PENDING,
-        "created_at": datetime.utcnow().isoformat(),
+        "created_at": created_at,
         "method": "xml",
         "result": None,
         "error": None,
         "completed_at": None,
-    }
-
-    background_tasks.add_task(
-        process_xml_job,
-        job_id,
-        xml_content,
-        request.webhook_url,
-        request.max_retries
+    })
+
+    callback_kwargs = {"job_id": job_id, "created_at": created_at, "webhook_url": request.webhook_url, "from_xml": True}
+    verify_xml_task.apply_async(
+        kwargs={"xml_content": xml_content, "max_captcha_retries": request.max_retries},
+        task_id=job_id,
+        link=job_completed_callback.s(**callback_kwargs),
+        link_error=job_failed_callback.s(**callback_kwargs),
     )
 
     return JobResponse(
         job_id=job_id,
         status=JobStatus.PENDING,
-        created_at=jobs[job_id]["created_at"],
+        created_at=created_at,
         message="Verification job created. Poll /jobs/{job_id} for results."
     )
 
 
+def save_xml_job(job_id: str, xml_hash: str, webhook_url: Optional[str], **values):
+    """Create the DB row of an async XML job."""
+    db = SessionLocal()
+    try:
+        db.add(Verification(
+            job_id=job_id,
+            method=VerificationMethod.XML,
+            xml_hash=xml_hash,
+            webhook_url=webhook_url,
+            **values,
+        ))
+        db.commit()
+    finally:
+        db.close()
+
+
 # Keep old endpoint for backwards compatibility
 @app.post("/verify", response_model=VerifyFolioResponse, tags=["Verification"], deprecated=True)
 async def verify_legacy(request: VerifyXMLRequest):
@@ -871,10 +816,18 @@ async def verify_legacy(request: VerifyXMLRequest):
 @app.get("/jobs/{job_id}", response_model=JobResult, tags=["Jobs"])
 async def get_job_status(job_id: str):
     """Get the status and result of a verification job."""
-    if job_id not in jobs:
+    job = await jobs.get(job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
 
-    job = jobs[job_id]
+    # The worker's progress is read from its Celery task; once finished, the
+    # outcome is copied into the job record so the backend isn't asked again
+    if job["status"] in (JobStatus.PENDING, JobStatus.PROCESSING):
+        outcome = await asyncio.to_thread(job_task_outcome, job_id)
+        if outcome and outcome["status"] != job["status"]:
+            job.update(outcome)
+            await jobs.update(job_id, **outcome)
+
     return JobResult(
         job_id=job_id,
         status=job["status"],
@@ -888,11 +841,8 @@ async def get_job_status(job_id: str):
 @app.get("/jobs", tags=["Jobs"])
 async def list_jobs(limit: int = 10):
     """List recent jobs."""
-    sorted_jobs = sorted(
-        jobs.items(),
-        key=lambda x: x[1]["created_at"],
-        reverse=True
-    )[:limit]
+    # Only the listed fields, not the stored results
+    recent_jobs = await jobs.recent(limit, fields=["status", "method", "created_at"])
 
     return [
         {
@@ -901,87 +851,115 @@ async def list_jobs(limit: int = 10):
             "method": job.get("method", "xml"),
             "created_at": job["created_at"],
         }
-        for job_id, job in sorted_jobs
+        for job_id, job in recent_jobs
     ]
 
 
 @app.delete("/jobs/{job_id}", tags=["Jobs"])
 async def delete_job(job_id: str):
-    """Delete a job from memory."""
-    if job_id not in jobs:
+    """Delete a job record."""
+    if not await jobs.delete(job_id):
         raise HTTPException(status_code=404, detail="Job not found")
 
-    del jobs[job_id]
     return {"message": "Job deleted"}
 
 
 # ---------- Batch Endpoints (Celery) ----------
 
-# In-memory batch tracking (use Redis in production for persistence)
-batches: dict[str, dict] = {}
-
+# Seconds an in-progress batch status is served from cache
+BATCH_STATUS_TTL = 2
 
-@app.post("/batch/verify", response_model=BatchResponse, tags=["Batch"])
-async def create_batch_verification(request: BatchRequest, db: Session = Depends(get_db)):
+def fetch_chunk_results(group_results: list[GroupResult]) -> dict:
     """
-    Submit a batch of CFDIs for verification.
-
-    - Accepts up to 500 items per batch
-    - Items are processed in parallel (3 concurrent workers)
-    - Use /batch/{batch_id} to check progress
-    - Optionally provide webhook_url for completion notification
+    Ready chunk task results of one or more batches, keyed by task id.
+    Everything is read with one MGET instead of one GET per chunk.
     """
-    if len(request.items) > 500:
-        raise HTTPException(status_code=400, detail="Maximum 500 items per batch")
+    task_ids = [result.id for group_result in group_results for result in group_result.results]
+    if not task_ids:
+        return {}
+    return dict(celery_app.backend.get_many(task_ids, interval=0, max_iterations=1))
 
-    if len(request.items) == 0:
-        raise HTTPException(status_code=400, detail="At least 1 item required")
 
+def batch_item_results(group_result: GroupResult, total: int, ready: dict) -> list[Optional[dict]]:
+    """Flatten a batch's chunk task results per item; None for items still pending."""
+    items = []
+    for result in group_result.results:
+        size = min(BATCH_CHUNK_SIZE, total - len(items))
+        meta = ready.get(result.id)
+        if meta is None:
+            items.extend([None] * size)
+        elif meta["status"] == states.SUCCESS:
+            items.extend(meta["result"])
+        else:
+            items.extend([{"error": str(meta["result"])}] * size)
+    return items
+
+
+async def start_batch(
+    items: list[BatchItem],
+    db: Session,
+    webhook_url: Optional[str] = None,
+    per_item_webhooks: bool = False,
+) -> tuple[str, dict, object]:
+    """
+    Record a batch and dispatch its chunk tasks.
+    Returns the batch id, its Redis record and the Celery group (or chord) result.
+    """
     batch_id = str(uuid.uuid4())
-    created_at = datetime.utcnow()
+    created_at = utcnow()
 
     # Create batch record in DB
     db_batch = Batch(
         batch_id=batch_id,
-        total_items=len(request.items),
-        webhook_url=request.webhook_url,
+        total_items=len(items),
+        webhook_url=webhook_url,
         status=VerificationStatus.PROCESSING
     )
     db.add(db_batch)
     db.commit()
     db.refresh(db_batch)
 
-    # Create verification records for each item
-    for i, item in enumerate(request.items):
-        db_verification = Verification(
-            job_id=str(uuid.uuid4()),
-            method=VerificationMethod.FOLIO,
-            folio_fiscal=item.id,
-            rfc_emisor=item.re,
-            rfc_receptor=item.rr,
-            status=VerificationStatus.PENDING,
-            batch_id=db_batch.id,
-            batch_index=i
-        )
-        db.add(db_verification)
+    # Create verification records for each item in a single executemany
+    db.execute(
+        insert(Verification),
+        [
+            {
+                "job_id": str(uuid.uuid4()),
+                "method": VerificationMethod.FOLIO,
+                "folio_fiscal": item.id,
+                "rfc_emisor": item.re,
+                "rfc_receptor": item.rr,
+                "status": VerificationStatus.PENDING,
+                "batch_id": db_batch.id,
+                "batch_index": i,
+            }
+            for i, item in enumerate(items)
+        ],
+    )
     db.commit()
 
-    # Create Celery tasks for each item
-    tasks = []
-    for i, item in enumerate(request.items):
-        task = verify_folio_task.s(
-            folio_fiscal=item.id,
-            rfc_emisor=item.re,
-            rfc_receptor=item.rr,
-            webhook_url=request.webhook_url,
+    # One Celery task per chunk of items, which run side by side on the workers
+    items = [{"id": item.id, "re": item.re, "rr": item.rr} for item in items]
+    tasks = [
+        verify_folio_chunk_task.s(
+            items=items[offset:offset + BATCH_CHUNK_SIZE],
             batch_id=batch_id,
-            item_index=i
+            offset=offset,
+            webhook_url=webhook_url,
+            send_per_item=per_item_webhooks,
         )
-        tasks.append(task)
+        for offset in range(0, len(items), BATCH_CHUNK_SIZE)
+    ]
+
+    # Progress counters, incremented by the workers as chunks finish
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(batch_counters_key(batch_id), mapping={"completed": 0, "failed": 0})
+        pipe.expire(batch_counters_key(batch_id), batches.ttl)
+        await pipe.execute()
 
     # Use chord: run all tasks in parallel, then call callback when all complete
-    if request.webhook_url:
-        job = chord(tasks)(batch_complete_callback.s(batch_id=batch_id, webhook_url=request.webhook_url))
+    if webhook_url:
+        job = chord(tasks)(batch_complete_callback.s(batch_id=batch_id, webhook_url=webhook_url))
     else:
         job = group(tasks).apply_async()
 
@@ -989,93 +967,215 @@ async def create_batch_verification(request: BatchRequest, db: Session = Depends
     db_batch.celery_group_id = job.id
     db.commit()
 
-    # Store in memory for backwards compatibility
-    batches[batch_id] = {
+    # Track in Redis for the status endpoints
+    batch = {
         "group_id": job.id,
-        "total": len(request.items),
+        "total": len(items),
         "created_at": created_at.isoformat(),
-        "webhook_url": request.webhook_url,
-        "items": [{"id": item.id, "re": item.re, "rr": item.rr} for item in request.items]
+        "webhook_url": webhook_url,
+        "status": "processing",
+        "items": items,
     }
+    await batches.create(batch_id, batch)
+
+    logger.info(f"Created batch {batch_id} with {len(items)} items")
+    return batch_id, batch, job
 
-    logger.info(f"Created batch {batch_id} with {len(request.items)} items")
+
+@app.post("/batch/verify", response_model=BatchResponse, tags=["Batch"])
+async def create_batch_verification(request: BatchRequest, db: Session = Depends(get_db)):
+    """
+    Submit a batch of CFDIs for verification.
+
+    - Accepts up to 500 items per batch
+    - Items are split into chunks of BATCH_CHUNK_SIZE, one Celery task each; a chunk
+      verifies up to BATCH_ITEM_CONCURRENCY items at once, over HTTP when SAT allows
+      and in the worker's shared browser otherwise
+    - Use /batch/{batch_id} to check progress
+    - Optionally provide webhook_url for a single completion notification
+      (set per_item_webhooks=true to also get one per item)
+    """
+    if len(request.items) > 500:
+        raise HTTPException(status_code=400, detail="Maximum 500 items per batch")
+
+    if len(request.items) == 0:
+        raise HTTPException(status_code=400, detail="At least 1 item required")
+
+    batch_id, batch, _ = await start_batch(request.items, db, request.webhook_url, request.per_item_webhooks)
 
     return BatchResponse(
         batch_id=batch_id,
         total_items=len(request.items),
         status="processing",
-        created_at=created_at.isoformat(),
+        created_at=batch["created_at"],
         message=f"Batch created. {len(request.items)} items queued for verification. Poll /batch/{batch_id} for status."
     )
 
 
-@app.get("/batch/{batch_id}", response_model=BatchStatusResponse, tags=["Batch"])
-async def get_batch_status(batch_id: str, include_results: bool = False):
+@app.post("/verify/folio/batch", response_model=BatchStatusResponse, tags=["Batch"])
+async def verify_folio_batch_sync(request: BatchRequest, db: Session = Depends(get_db)):
     """
-    Get the status of a batch verification job.
+    Verify a small batch of CFDIs and wait for all results (synchronous).
 
-    - Set include_results=true to get individual results (only when completed)
+    - Accepts up to SYNC_BATCH_MAX_ITEMS items (default 50)
+    - Chunks run in parallel on the workers, as with /batch/verify
+    - The batch is also recorded, so /batch/{batch_id} works afterwards
     """
-    if batch_id not in batches:
-        raise HTTPException(status_code=404, detail="Batch not found")
+    if len(request.items) > SYNC_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Maximum {SYNC_BATCH_MAX_ITEMS} items per synchronous batch, use /batch/verify for more",
+        )
+
+    if len(request.items) == 0:
+        raise HTTPException(status_code=400, detail="At least 1 item required")
+
+    batch_id, batch, job = await start_batch(request.items, db, request.webhook_url, request.per_item_webhooks)
+    # With a webhook the chord's callback is returned; the chunks are its parent group
+    group_result = job.parent if request.webhook_url else job
+
+    chunk_results = await asyncio.gather(
+        *[wait_for_task(result) for result in group_result.results],
+        return_exceptions=True,
+    )
+
+    results_list = []
+    for offset, chunk in zip(range(0, len(request.items), BATCH_CHUNK_SIZE), chunk_results):
+        if isinstance(chunk, Exception):
+            size = min(BATCH_CHUNK_SIZE, len(request.items) - offset)
+            chunk = [{"error": str(chunk) or type(chunk).__name__}] * size
+        results_list.extend(chunk)
+
+    failed = sum(1 for result in results_list if "error" in result)
+    return await settle_batch_status(batch_id, batch, len(results_list) - failed, failed, results_list)
+
+
+def batch_status_key(batch_id: str) -> str:
+    return f"cfdi:batch_status:{batch_id}"
+
+
+async def compute_batch_status(batch_id: str, batch: dict, include_results: bool = False) -> BatchStatusResponse:
+    """
+    Status of a batch from its Celery results.
+
+    Once a batch is complete its counts are saved in its Redis record, so later
+    calls that don't need results skip the result backend entirely. While it
+    runs, the counters kept by the workers are read instead. When those are
+    missing, a batch whose items are all saved is answered from the DB;
+    otherwise the chunk results are scanned and the counts cached for
+    BATCH_STATUS_TTL seconds so rapid polling doesn't repeat the scan.
+    """
+    if not include_results:
+        if batch.get("status") == "completed":
+            return stored_batch_status(batch_id, batch)
+
+        counters = await redis_client.hgetall(batch_counters_key(batch_id))
+        if counters:
+            return await settle_batch_status(
+                batch_id, batch, int(counters["completed"]), int(counters["failed"])
+            )
+
+        cached = await redis_client.get(batch_status_key(batch_id))
+        if cached:
+            return BatchStatusResponse.model_validate_json(cached)
+
+        # Every item already saved by the workers: answer from the DB, which
+        # also outlives the Celery results
+        counts = await asyncio.to_thread(batch_db_counts, batch_id)
+        if (
+            sum(counts.values()) == batch["total"]
+            and not counts.get(VerificationStatus.PENDING)
+            and not counts.get(VerificationStatus.PROCESSING)
+        ):
+            return await settle_batch_status(
+                batch_id,
+                batch,
+                counts.get(VerificationStatus.COMPLETED, 0),
+                counts.get(VerificationStatus.FAILED, 0),
+            )
 
-    batch = batches[batch_id]
     group_result = GroupResult.restore(batch["group_id"], app=celery_app)
+    ready = fetch_chunk_results([group_result]) if group_result is not None else {}
+    return await summarize_batch(batch_id, batch, group_result, ready, include_results)
+
 
+def batch_db_counts(batch_id: str) -> dict[VerificationStatus, int]:
+    """Verification counts per status for a batch, one aggregate over ix_verif_batch_status."""
+    db = SessionLocal()
+    try:
+        rows = db.query(Verification.status, func.count()).join(
+            Batch, Verification.batch_id == Batch.id
+        ).filter(Batch.batch_id == batch_id).group_by(Verification.status).all()
+    finally:
+        db.close()
+    return dict(rows)
+
+
+def stored_batch_status(batch_id: str, batch: dict) -> BatchStatusResponse:
+    """Status of a finished batch from the counts saved in its record."""
+    return BatchStatusResponse(
+        batch_id=batch_id,
+        status="completed",
+        total=batch["total"],
+        completed=batch["completed"],
+        failed=batch["failed"],
+        pending=0,
+    )
+
+
+async def summarize_batch(
+    batch_id: str,
+    batch: dict,
+    group_result: Optional[GroupResult],
+    ready: dict,
+    include_results: bool = False,
+) -> BatchStatusResponse:
+    """Count a batch's results from already fetched chunk results and store the outcome."""
     if group_result is None:
         # Try as AsyncResult (for chord)
         async_result = AsyncResult(batch["group_id"], app=celery_app)
-        if async_result.ready():
-            results = async_result.result
-            if isinstance(results, dict) and "results" in results:
-                # Chord callback result
-                all_results = results["results"]
-                completed = sum(1 for r in all_results if r and r.get("valid") is not None)
-                failed = len(all_results) - completed
-
-                return BatchStatusResponse(
-                    batch_id=batch_id,
-                    status="completed",
-                    total=batch["total"],
-                    completed=completed,
-                    failed=failed,
-                    pending=0,
-                    results=all_results if include_results else None
-                )
-
-        return BatchStatusResponse(
-            batch_id=batch_id,
-            status="processing",
-            total=batch["total"],
-            completed=0,
-            failed=0,
-            pending=batch["total"],
-            results=None
-        )
-
-    # Count completed/failed/pending
-    completed = 0
-    failed = 0
-    results_list = []
-
-    for result in group_result.results:
-        if result.ready():
-            if result.successful():
-                completed += 1
-                if include_results:
-                    results_list.append(result.result)
-            else:
-                failed += 1
-                if include_results:
-                    results_list.append({"error": str(result.result)})
-        else:
-            if include_results:
-                results_list.append(None)
+        results = async_result.result if async_result.ready() else None
+        if not (isinstance(results, dict) and "results" in results):
+            return BatchStatusResponse(
+                batch_id=batch_id,
+                status="processing",
+                total=batch["total"],
+                completed=0,
+                failed=0,
+                pending=batch["total"],
+                results=None
+            )
+
+        # Chord callback result
+        results_list = results["results"]
+        completed = sum(1 for r in results_list if r and r.get("valid") is not None)
+        failed = len(results_list) - completed
+    else:
+        # Count completed/failed
+        results_list = batch_item_results(group_result, batch["total"], ready)
+        failed = sum(1 for r in results_list if r is not None and "error" in r)
+        completed = sum(1 for r in results_list if r is not None) - failed
 
+    batch_status = await settle_batch_status(
+        batch_id, batch, completed, failed, results_list if include_results else None
+    )
+    if batch_status.status != "completed" and not include_results:
+        await redis_client.set(batch_status_key(batch_id), batch_status.model_dump_json(), ex=BATCH_STATUS_TTL)
+    return batch_status
+
+
+async def settle_batch_status(
+    batch_id: str,
+    batch: dict,
+    completed: int,
+    failed: int,
+    results_list: Optional[list] = None,
+) -> BatchStatusResponse:
+    """Status for the given counts, saving them in the batch record once it's done."""
     pending = batch["total"] - completed - failed
-
     if pending == 0:
         status = "completed"
+        await batches.update(batch_id, status=status, completed=completed, failed=failed)
     elif completed + failed > 0:
         status = "processing"
     else:
@@ -1088,91 +1188,191 @@ async def get_batch_status(batch_id: str, include_results: bool = False):
         completed=completed,
         failed=failed,
         pending=pending,
-        results=results_list if include_results and status == "completed" else None
+        results=results_list if status == "completed" else None
     )
 
 
+@app.get("/batch/{batch_id}", response_model=BatchStatusResponse, tags=["Batch"])
+async def get_batch_status(batch_id: str, request: Request, response: Response, include_results: bool = False):
+    """
+    Get the status of a batch verification job.
+
+    - Set include_results=true to get individual results (only when completed)
+    - Completed batches carry an ETag; send it in If-None-Match to get a 304
+    """
+    batch = await batches.get(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+
+    if batch.get("status") == "completed":
+        etag = make_etag(batch_id, batch["completed"], batch["failed"], include_results)
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": TERMINAL_CACHE_CONTROL})
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = TERMINAL_CACHE_CONTROL
+
+    return await compute_batch_status(batch_id, batch, include_results)
+
+
 @app.get("/batch", tags=["Batch"])
 async def list_batches(limit: int = 10):
     """List recent batches."""
-    sorted_batches = sorted(
-        batches.items(),
-        key=lambda x: x[1]["created_at"],
-        reverse=True
-    )[:limit]
+    # Skip the stored item list, it can hold 500 entries per batch
+    recent_batches = await batches.recent(
+        limit, fields=["group_id", "total", "created_at", "status", "completed", "failed"]
+    )
 
-    result = []
-    for batch_id, batch in sorted_batches:
-        # Get quick status
-        group_result = GroupResult.restore(batch["group_id"], app=celery_app)
-        if group_result:
-            completed = sum(1 for r in group_result.results if r.ready() and r.successful())
-            pending = batch["total"] - completed
-            status = "completed" if pending == 0 else "processing"
-        else:
-            status = "processing"
-            completed = 0
+    # Finished batches have stored counts and running ones have worker counters
+    # or a cached status; the rest are counted from one MGET over all their
+    # chunk results
+    open_batches = [(batch_id, batch) for batch_id, batch in recent_batches if batch.get("status") != "completed"]
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for batch_id, _ in open_batches:
+            pipe.hgetall(batch_counters_key(batch_id))
+            pipe.get(batch_status_key(batch_id))
+        replies = await pipe.execute()
+
+    statuses = {}
+    for (batch_id, batch), counters, cached in zip(open_batches, replies[::2], replies[1::2]):
+        if counters:
+            statuses[batch_id] = await settle_batch_status(
+                batch_id, batch, int(counters["completed"]), int(counters["failed"])
+            )
+        elif cached:
+            statuses[batch_id] = BatchStatusResponse.model_validate_json(cached)
+    group_results = {
+        batch_id: GroupResult.restore(batch["group_id"], app=celery_app)
+        for batch_id, batch in open_batches
+        if batch_id not in statuses
+    }
+    ready = fetch_chunk_results([g for g in group_results.values() if g is not None])
+    for batch_id, batch in open_batches:
+        if batch_id in group_results:
+            statuses[batch_id] = await summarize_batch(batch_id, batch, group_results[batch_id], ready)
 
+    result = []
+    for batch_id, batch in recent_batches:
+        batch_status = statuses.get(batch_id) or stored_batch_status(batch_id, batch)
         result.append({
             "batch_id": batch_id,
             "total": batch["total"],
-            "completed": completed,
-            "status": status,
+            "completed": batch_status.completed,
+            "status": "completed" if batch_status.status == "completed" else "processing",
             "created_at": batch["created_at"],
         })
 
     return result
 
 
+def revoke_group(group_id: str):
+    """Revoke every task of a batch's group; runs in the threadpool, it broadcasts to all workers."""
+    group_result = GroupResult.restore(group_id, app=celery_app)
+    if group_result:
+        group_result.revoke(terminate=True)
+        logger.info(f"Revoked {len(group_result.results)} tasks of group {group_id}")
+
+
 @app.delete("/batch/{batch_id}", tags=["Batch"])
-async def cancel_batch(batch_id: str):
-    """Cancel a batch and revoke pending tasks."""
-    if batch_id not in batches:
+async def cancel_batch(batch_id: str, background_tasks: BackgroundTasks):
+    """Cancel a batch and revoke pending tasks (after the response is sent)."""
+    batch = await batches.get(batch_id)
+    if batch is None:
         raise HTTPException(status_code=404, detail="Batch not found")
 
-    batch = batches[batch_id]
-    group_result = GroupResult.restore(batch["group_id"], app=celery_app)
+    background_tasks.add_task(revoke_group, batch["group_id"])
 
-    if group_result:
-        group_result.revoke(terminate=True)
-
-    del batches[batch_id]
+    await batches.delete(batch_id)
+    await redis_client.delete(batch_status_key(batch_id), batch_counters_key(batch_id))
     return {"message": f"Batch {batch_id} cancelled"}
 
 
 @app.get("/queue/stats", tags=["System"])
 async def queue_stats():
-    """Get Celery queue statistics."""
-    inspect = celery_app.control.inspect()
+    """
+    Get Celery queue statistics.
 
+    Read from the heartbeats the workers write to Redis every few seconds,
+    rather than broadcasting an inspect request and waiting for replies.
+    """
     try:
-        active = inspect.active() or {}
-        reserved = inspect.reserved() or {}
-        stats = inspect.stats() or {}
-
-        total_active = sum(len(tasks) for tasks in active.values())
-        total_reserved = sum(len(tasks) for tasks in reserved.values())
-
-        return {
-            "workers": list(stats.keys()),
-            "active_tasks": total_active,
-            "reserved_tasks": total_reserved,
-            "batches_in_memory": len(batches)
+        keys = [key async for key in redis_client.scan_iter(match=worker_heartbeat_key("*"), count=100)]
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hgetall(key)
+            heartbeats = await pipe.execute()
+
+        workers = {
+            key.removeprefix(worker_heartbeat_key("")): heartbeat
+            for key, heartbeat in zip(keys, heartbeats)
+            if heartbeat
+        }
+        stats = {
+            "workers": sorted(workers),
+            "active_tasks": sum(int(h["active"]) for h in workers.values()),
+            "reserved_tasks": sum(int(h["reserved"]) for h in workers.values()),
+            "batches_in_memory": await batches.count(),
         }
+        if not workers:
+            stats["message"] = "No workers running"
+        return stats
     except Exception as e:
-        return {"error": str(e), "message": "Celery workers may not be running"}
+        return {"error": str(e), "message": "Could not read worker heartbeats"}
+
+
+# Only what /history returns (plus id for the cursor), as plain rows rather than ORM objects
+# Enums come back as their values (the lowercased stored names) so rows
+# skip SQLAlchemy's enum conversion
+HISTORY_COLUMNS = (
+    Verification.id,
+    Verification.job_id,
+    Verification.folio_fiscal,
+    Verification.rfc_emisor,
+    Verification.rfc_receptor,
+    func.lower(cast(Verification.method, String)).label("method"),
+    func.lower(cast(Verification.status, String)).label("status"),
+    Verification.valid,
+    Verification.sat_response,
+    Verification.error_message,
+    Verification.created_at,
+    Verification.completed_at,
+)
+
+# Rows fetched per round trip while streaming /history
+HISTORY_YIELD_PER = 500
+
+# Response keys for HISTORY_COLUMNS, leaving out the id used for the cursor
+HISTORY_FIELDS = tuple(column.key for column in HISTORY_COLUMNS[1:])
+
+
+def history_row(row) -> dict:
+    """Result dict for a HISTORY_COLUMNS row; datetimes are left to orjson."""
+    return dict(zip(HISTORY_FIELDS, row[1:]))
+
+
+def encode_history_cursor(created_at: datetime, row_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{row_id}".encode()).decode()
+
+
+def decode_history_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        created_at, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(row_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 
 @app.get("/history", tags=["History"])
-async def get_verification_history(
+def get_verification_history(
     db: Session = Depends(get_db),
     limit: int = 50,
     offset: int = 0,
+    cursor: Optional[str] = None,
     folio_fiscal: Optional[str] = None,
     rfc_emisor: Optional[str] = None,
     rfc_receptor: Optional[str] = None,
     status: Optional[str] = None,
-    valid: Optional[bool] = None
+    valid: Optional[bool] = None,
+    with_total: bool = False
 ):
     """
     Query verification history from database.
@@ -1183,6 +1383,10 @@ async def get_verification_history(
     - rfc_receptor: Exact match
     - status: pending, processing, completed, failed
     - valid: true/false
+
+    For deep pages pass the previous response's next_cursor as cursor
+    instead of increasing offset. total is only counted with with_total=true;
+    use has_more to decide whether to fetch another page.
     """
     query = db.query(Verification)
 
@@ -1197,72 +1401,135 @@ async def get_verification_history(
     if valid is not None:
         query = query.filter(Verification.valid == valid)
 
-    total = query.count()
-    verifications = query.order_by(Verification.created_at.desc()).offset(offset).limit(limit).all()
+    # Counting the whole filtered set is a full scan, only do it on request
+    total = query.count() if with_total else None
 
-    return {
-        "total": total,
-        "limit": limit,
-        "offset": offset,
-        "results": [
-            {
-                "job_id": v.job_id,
-                "folio_fiscal": v.folio_fiscal,
-                "rfc_emisor": v.rfc_emisor,
-                "rfc_receptor": v.rfc_receptor,
-                "method": v.method.value if v.method else None,
-                "status": v.status.value if v.status else None,
-                "valid": v.valid,
-                "sat_response": v.sat_response,
-                "error_message": v.error_message,
-                "created_at": v.created_at.isoformat() if v.created_at else None,
-                "completed_at": v.completed_at.isoformat() if v.completed_at else None,
-            }
-            for v in verifications
-        ]
-    }
+    if cursor:
+        # Keyset pagination: continue strictly after the last row of the previous page
+        cursor_created_at, cursor_id = decode_history_cursor(cursor)
+        query = query.filter(tuple_(Verification.created_at, Verification.id) < (cursor_created_at, cursor_id))
+    elif offset:
+        query = query.offset(offset)
+
+    # One extra row tells us whether another page exists
+    statement = query.with_entities(*HISTORY_COLUMNS).order_by(
+        Verification.created_at.desc(), Verification.id.desc()
+    ).limit(limit + 1).statement
+
+    return StreamingResponse(
+        stream_history(statement, {"total": total, "limit": limit, "offset": offset}, limit),
+        media_type="application/json",
+    )
+
+
+def stream_history(statement, header: dict, limit: int):
+    """
+    Yield the /history JSON a batch of rows at a time, read through a
+    server-side cursor so memory stays bounded by HISTORY_YIELD_PER rows.
+    has_more and next_cursor depend on the last row, so they close the object.
+    """
+    # Own session: the request's one may be closed before the body is streamed
+    db = SessionLocal()
+    try:
+        yield orjson.dumps(header)[:-1] + b',"results":['
+
+        sent = 0
+        last = None
+        has_more = False
+        result = db.execute(statement.execution_options(yield_per=HISTORY_YIELD_PER))
+        for partition in result.partitions():
+            rows = partition[:limit - sent]
+            has_more = has_more or len(rows) < len(partition)
+            if rows:
+                yield (b"," if sent else b"") + b",".join(orjson.dumps(history_row(row)) for row in rows)
+                sent += len(rows)
+                last = rows[-1]
+
+        next_cursor = encode_history_cursor(last.created_at, last.id) if has_more and last else None
+        yield b"]," + orjson.dumps({"has_more": has_more, "next_cursor": next_cursor})[1:]
+    finally:
+        db.close()
+
+
+# Everything /history/{job_id} returns, with the batch's public id from one outer join
+VERIFICATION_DETAIL_COLUMNS = (
+    Verification.job_id,
+    Verification.folio_fiscal,
+    Verification.rfc_emisor,
+    Verification.rfc_receptor,
+    Verification.method,
+    Verification.status,
+    Verification.valid,
+    Verification.sat_response,
+    Verification.error_message,
+    Verification.webhook_url,
+    Verification.webhook_sent,
+    Batch.batch_id,
+    Verification.created_at,
+    Verification.started_at,
+    Verification.completed_at,
+)
 
 
 @app.get("/history/{job_id}", tags=["History"])
-async def get_verification_by_job_id(job_id: str, db: Session = Depends(get_db)):
-    """Get a specific verification by job_id."""
-    verification = db.query(Verification).filter(Verification.job_id == job_id).first()
+def get_verification_by_job_id(job_id: str, request: Request, response: Response, db: Session = Depends(get_db)):
+    """Get a specific verification by job_id. Finished ones carry an ETag."""
+    verification = db.query(*VERIFICATION_DETAIL_COLUMNS).outerjoin(
+        Batch, Verification.batch_id == Batch.id
+    ).filter(Verification.job_id == job_id).one_or_none()
 
     if not verification:
         raise HTTPException(status_code=404, detail="Verification not found")
 
-    return {
-        "job_id": verification.job_id,
-        "folio_fiscal": verification.folio_fiscal,
-        "rfc_emisor": verification.rfc_emisor,
-        "rfc_receptor": verification.rfc_receptor,
-        "method": verification.method.value if verification.method else None,
-        "status": verification.status.value if verification.status else None,
-        "valid": verification.valid,
-        "sat_response": verification.sat_response,
-        "error_message": verification.error_message,
-        "webhook_url": verification.webhook_url,
-        "webhook_sent": verification.webhook_sent,
-        "batch_id": verification.batch.batch_id if verification.batch else None,
-        "created_at": verification.created_at.isoformat() if verification.created_at else None,
-        "started_at": verification.started_at.isoformat() if verification.started_at else None,
-        "completed_at": verification.completed_at.isoformat() if verification.completed_at else None,
-    }
+    if verification.completed_at:
+        # webhook_sent is still set after completion
+        etag = make_etag(job_id, verification.completed_at.isoformat(), verification.webhook_sent)
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": TERMINAL_CACHE_CONTROL})
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = TERMINAL_CACHE_CONTROL
 
+    # Enums and datetimes are encoded as their value / ISO string by FastAPI
+    return dict(verification._mapping)
 
-@app.get("/stats", tags=["System"])
-async def get_stats(db: Session = Depends(get_db)):
-    """Get verification statistics."""
-    total = db.query(Verification).count()
-    completed = db.query(Verification).filter(Verification.status == VerificationStatus.COMPLETED).count()
-    failed = db.query(Verification).filter(Verification.status == VerificationStatus.FAILED).count()
-    pending = db.query(Verification).filter(Verification.status == VerificationStatus.PENDING).count()
-    processing = db.query(Verification).filter(Verification.status == VerificationStatus.PROCESSING).count()
 
-    valid_count = db.query(Verification).filter(Verification.valid == True).count()
-    invalid_count = db.query(Verification).filter(Verification.valid == False).count()
+@app.get("/stats", tags=["System"])
+def get_stats(db: Session = Depends(get_db)):
+    """
+    Get verification statistics.
 
-    total_batches = db.query(Batch).count()
+    On Postgres these come from materialized views refreshed every
+    STATS_REFRESH_SECONDS by the Celery beat schedule.
+    """
+    if stats_views_enabled():
+        validity = {"valid": True, "invalid": False, "unknown": None}
+        rows = [
+            (VerificationStatus[status], validity[valid], n)
+            for status, valid, n in db.execute(text("SELECT status, validity, n FROM verification_stats"))
+        ]
+        total_batches = db.execute(text("SELECT total FROM batch_stats")).scalar() or 0
+    else:
+        # One scan for every status/validity combination, tallied below
+        rows = db.query(Verification.status, Verification.valid, func.count()).group_by(
+            Verification.status, Verification.valid
+        ).all()
+        total_batches = db.query(Batch).count()
+
+    by_status = {status: 0 for status in VerificationStatus}
+    valid_count = 0
+    invalid_count = 0
+    for status, valid, n in rows:
+        by_status[status] += n
+        if valid is True:
+            valid_count += n
+        elif valid is False:
+            invalid_count += n
+
+    total = sum(by_status.values())
+    completed = by_status[VerificationStatus.COMPLETED]
+    failed = by_status[VerificationStatus.FAILED]
+    pending = by_status[VerificationStatus.PENDING]
+    processing = by_status[VerificationStatus.PROCESSING]
 
     return {
         "verifications": {
@@ -1293,25 +1560,21 @@ COST_DO_POSTGRES_MONTHLY = 0.0  # Dev database is free
 COST_REDIS_MONTHLY = 0.0        # Redis Cloud free tier
 
 
-@app.get("/costs", tags=["Costs"])
-async def get_costs(db: Session = Depends(get_db)):
-    """
-    Get cost breakdown based on actual usage.
+def usage_counts() -> dict:
+    """Completed/failed verification counts for today, this month and all time (blocking)."""
+    # Own session: this runs on a worker thread, and sessions aren't thread-safe
+    db = SessionLocal()
+    try:
+        return count_usage(db)
+    finally:
+        db.close()
 
-    Returns costs for today, this month, and all-time.
-    """
-    from datetime import timedelta
-    from sqlalchemy import func
 
-    now = datetime.utcnow()
+def count_usage(db: Session) -> dict:
+    now = utcnow()
     today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
     month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
 
-    # Count verifications
-    total_all = db.query(Verification).count()
-    total_month = db.query(Verification).filter(Verification.created_at >= month_start).count()
-    total_today = db.query(Verification).filter(Verification.created_at >= today_start).count()
-
     # Count completed (successful CAPTCHA solves)
     completed_all = db.query(Verification).filter(Verification.status == VerificationStatus.COMPLETED).count()
     completed_month = db.query(Verification).filter(
@@ -1334,6 +1597,37 @@ async def get_costs(db: Session = Depends(get_db)):
         Verification.created_at >= today_start
     ).count()
 
+    return {
+        "today": (completed_today, failed_today),
+        "month": (completed_month, failed_month),
+        "all_time": (completed_all, failed_all),
+    }
+
+
+async def fetch_twocaptcha_balance() -> float:
+    """Current 2Captcha account balance in USD."""
+    response = await app.state.http.get(f"{TWOCAPTCHA_URL}/res.php", params={
+        "key": os.getenv("TWOCAPTCHA_API_KEY"),
+        "action": "getbalance",
+        "json": 1,
+    })
+    response.raise_for_status()
+    data = response.json()
+    if data["status"] != 1:
+        raise ValueError(f"2Captcha error: {data['request']}")
+    return float(data["request"])
+
+
+@app.get("/costs", tags=["Costs"])
+async def get_costs():
+    """
+    Get cost breakdown based on actual usage.
+
+    Returns costs for today, this month, and all-time.
+    """
+    # Sync DB queries, kept off the event loop
+    counts = await asyncio.to_thread(usage_counts)
+
     # Estimate CAPTCHA solves (completed + failed attempts, with retry rate)
     def calc_captcha_cost(completed: int, failed: int) -> dict:
         estimated_solves = int((completed + failed) * COST_CAPTCHA_RETRY_RATE)
@@ -1347,18 +1641,15 @@ async def get_costs(db: Session = Depends(get_db)):
     # Get 2Captcha balance
     twocaptcha_balance = None
     try:
-        api_key = os.getenv("TWOCAPTCHA_API_KEY")
-        if api_key:
-            solver = TwoCaptcha(api_key)
-            balance = solver.balance()
-            twocaptcha_balance = round(float(balance), 2)
+        if os.getenv("TWOCAPTCHA_API_KEY"):
+            twocaptcha_balance = round(await fetch_twocaptcha_balance(), 2)
     except Exception as e:
         logger.error(f"Failed to get 2Captcha balance: {e}")
 
     return {
-        "today": calc_captcha_cost(completed_today, failed_today),
-        "month": calc_captcha_cost(completed_month, failed_month),
-        "all_time": calc_captcha_cost(completed_all, failed_all),
+        "today": calc_captcha_cost(*counts["today"]),
+        "month": calc_captcha_cost(*counts["month"]),
+        "all_time": calc_captcha_cost(*counts["all_time"]),
         "twocaptcha_balance": twocaptcha_balance,
         "rates": {
             "cost_per_captcha": COST_2CAPTCHA_PER_SOLVE,
@@ -1526,4 +1817,17 @@ async def health_check():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+
+    # Job and batch state lives in Redis, so workers can run side by side
+    limit_concurrency = os.getenv("API_LIMIT_CONCURRENCY")
+    uvicorn.run(
+        "api:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("API_WORKERS", max(2, os.cpu_count() or 1))),
+        loop="uvloop",
+        http="httptools",
+        log_level=os.getenv("API_LOG_LEVEL", "warning"),
+        limit_concurrency=int(limit_concurrency) if limit_concurrency else None,
+        backlog=int(os.getenv("API_BACKLOG", "2048")),
+    )
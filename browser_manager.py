@@ -0,0 +1,85 @@
+"""
+Shared Playwright browser for the Celery worker processes.
+One Chromium is launched per process and reused; every page gets its own
+BrowserContext, so verifications don't share cookies or SAT sessions.
+The workers drive it from their browser loop thread (tasks.py).
+"""
+import asyncio
+import logging
+import os
+
+from playwright.async_api import async_playwright
+
+logger = logging.getLogger("cfdi-browser")
+
+# Skip assets the form doesn't need (the CAPTCHA image is kept)
+BLOCK_ASSETS = os.getenv("BROWSER_BLOCK_ASSETS", "true").lower() in ("1", "true", "yes")
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media", "stylesheet"}
+BLOCKED_HOSTS = ("google-analytics.com", "googletagmanager.com", "doubleclick.net")
+
+# Playwright already launches Chromium without the sandbox, /dev/shm, extensions,
+# sync or background networking; only the GPU process is left to skip. Don't add
+# --disable-features here, it would replace Playwright's own list.
+CHROMIUM_ARGS = ["--disable-gpu"]
+
+_playwright = None
+_browser = None
+_lock = asyncio.Lock()
+
+
+def should_block(request) -> bool:
+    """True for requests a verification can do without."""
+    if not BLOCK_ASSETS:
+        return False
+    url = request.url.lower()
+    if "captcha" in url:
+        return False
+    return request.resource_type in BLOCKED_RESOURCE_TYPES or any(host in url for host in BLOCKED_HOSTS)
+
+
+async def block_assets(route):
+    if should_block(route.request):
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+async def get_browser():
+    """Return the shared browser, launching it (again, if it crashed) as needed."""
+    global _playwright, _browser
+    if _browser is not None and _browser.is_connected():
+        return _browser
+
+    async with _lock:
+        if _browser is not None and _browser.is_connected():
+            return _browser
+        if _browser is not None:
+            logger.warning("Browser disconnected, relaunching")
+        if _playwright is None:
+            _playwright = await async_playwright().start()
+        _browser = await _playwright.chromium.launch(headless=True, args=CHROMIUM_ARGS)
+        logger.info("Browser launched")
+        return _browser
+
+
+def retire_browser(browser):
+    """
+    Make later get_browser() calls launch a fresh browser. The retired one
+    stays usable; its owner closes it once its open contexts are done.
+    """
+    global _browser
+    if _browser is browser:
+        _browser = None
+        logger.info("Browser retired")
+
+
+async def close_browser():
+    """Close the shared browser and stop Playwright."""
+    global _playwright, _browser
+    if _browser is not None:
+        await _browser.close()
+        _browser = None
+    if _playwright is not None:
+        await _playwright.stop()
+        _playwright = None
+
@@ -0,0 +1,102 @@
+"""
+Local CAPTCHA solver backed by an ONNX model.
+Enabled when CAPTCHA_MODEL_PATH points to a model file; low-confidence
+predictions return None so callers fall back to 2Captcha.
+Also cleans up images before they are sent to 2Captcha.
+"""
+import io
+import logging
+import os
+from typing import Optional
+
+logger = logging.getLogger("cfdi-captcha")
+
+CAPTCHA_MODEL_PATH = os.getenv("CAPTCHA_MODEL_PATH")
+CAPTCHA_MODEL_CHARSET = os.getenv("CAPTCHA_MODEL_CHARSET", "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+CAPTCHA_MIN_CONFIDENCE = float(os.getenv("CAPTCHA_MIN_CONFIDENCE", "0.85"))
+
+# Grayscale + autocontrast + threshold before 2Captcha (CAPTCHA_THRESHOLD=0 skips the threshold)
+CAPTCHA_PREPROCESS = os.getenv("CAPTCHA_PREPROCESS", "true").lower() in ("1", "true", "yes")
+CAPTCHA_THRESHOLD = int(os.getenv("CAPTCHA_THRESHOLD", "128"))
+
+# Model input (width, height), grayscale scaled to [0, 1]
+INPUT_SIZE = (120, 40)
+
+_session = None
+_load_failed = False
+
+
+def get_session():
+    """Load the ONNX model once per process. Returns None if disabled or broken."""
+    global _session, _load_failed
+    if _session is None and not _load_failed and CAPTCHA_MODEL_PATH:
+        try:
+            import onnxruntime
+            _session = onnxruntime.InferenceSession(
+                CAPTCHA_MODEL_PATH, providers=["CPUExecutionProvider"]
+            )
+            logger.info(f"Loaded CAPTCHA model from {CAPTCHA_MODEL_PATH}")
+        except Exception as e:
+            _load_failed = True
+            logger.warning(f"Local CAPTCHA model unavailable, using 2Captcha only: {e}")
+    return _session
+
+
+def predict(image_bytes: bytes) -> Optional[str]:
+    """
+    Read the CAPTCHA with the local model.
+
+    Returns None when the model is disabled or any character falls below
+    CAPTCHA_MIN_CONFIDENCE.
+    """
+    session = get_session()
+    if session is None:
+        return None
+
+    import numpy as np
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(image_bytes)).convert("L").resize(INPUT_SIZE)
+    arr = np.asarray(img, dtype=np.float32) / 255.0
+    input_name = session.get_inputs()[0].name
+    logits = session.run(None, {input_name: arr[None, None]})[0][0]  # (timesteps, classes)
+
+    probs = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    probs /= probs.sum(axis=-1, keepdims=True)
+    best = probs.argmax(axis=-1)
+
+    # Greedy CTC decode, class 0 is the blank
+    chars = []
+    confidences = []
+    prev = 0
+    for t, k in enumerate(best):
+        if k != 0 and k != prev:
+            chars.append(CAPTCHA_MODEL_CHARSET[k - 1])
+            confidences.append(float(probs[t, k]))
+        prev = k
+
+    if not chars or min(confidences) < CAPTCHA_MIN_CONFIDENCE:
+        return None
+    return "".join(chars)
+
+
+def preprocess(image_bytes: bytes) -> bytes:
+    """
+    Black-on-white PNG of the CAPTCHA, which human and OCR solvers misread less.
+    Returns the original bytes if preprocessing is disabled or the image can't be read.
+    """
+    if not CAPTCHA_PREPROCESS:
+        return image_bytes
+
+    from PIL import Image, ImageOps
+
+    try:
+        img = ImageOps.autocontrast(Image.open(io.BytesIO(image_bytes)).convert("L"))
+        if CAPTCHA_THRESHOLD:
+            img = img.point(lambda p: 255 if p > CAPTCHA_THRESHOLD else 0)
+        buf = io.BytesIO()
+        img.save(buf, "PNG", optimize=True)
+        return buf.getvalue()
+    except Exception as e:
+        logger.warning(f"CAPTCHA preprocessing failed, sending the original: {e}")
+        return image_bytes
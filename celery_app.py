@@ -2,14 +2,29 @@
 Celery configuration for CFDI Verifier.
 """
 import os
+
+import orjson
 from celery import Celery
 from dotenv import load_dotenv
+from kombu.serialization import register
 
 load_dotenv()
 
 # Redis URL from environment or default
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 
+# Task arguments and results are plain JSON; orjson encodes/decodes them faster
+register(
+    "orjson",
+    orjson.dumps,
+    orjson.loads,
+    content_type="application/x-orjson",
+    content_encoding="utf-8",
+)
+
+# Seconds a single verification may take on a worker (enforced in tasks.py)
+VERIFY_TIMEOUT = int(os.getenv("VERIFY_TIMEOUT", "120"))
+
 celery_app = Celery(
     "cfdi_verifier",
     broker=REDIS_URL,
@@ -18,27 +33,43 @@ celery_app = Celery(
 )
 
 celery_app.conf.update(
-    # Limit concurrency to prevent resource exhaustion
-    worker_concurrency=3,
+    # Verifications mostly wait on SAT and 2Captcha; threads share one browser
+    # per worker process (see tasks.py). The threads pool ignores Celery's
+    # soft_time_limit/time_limit, so none are set; tasks.py bounds each
+    # verification by VERIFY_TIMEOUT instead.
+    worker_pool="threads",
+    worker_concurrency=10,
 
     # Prefetch only 1 task per worker (important for long-running tasks)
     worker_prefetch_multiplier=1,
 
     # Task settings
-    task_serializer="json",
-    accept_content=["json"],
-    result_serializer="json",
+    # "json" stays accepted for messages queued before the switch
+    task_serializer="orjson",
+    accept_content=["orjson", "json"],
+    result_serializer="orjson",
     timezone="UTC",
     enable_utc=True,
 
     # Result expiration (24 hours)
     result_expires=86400,
 
-    # Task time limits
-    task_soft_time_limit=120,  # 2 minutes soft limit
-    task_time_limit=180,       # 3 minutes hard limit
+    # Report STARTED, so async jobs show as processing
+    task_track_started=True,
 
     # Retry settings
     task_acks_late=True,
     task_reject_on_worker_lost=True,
+
+    # Periodic tasks (run the worker with --beat, or a separate celery beat)
+    beat_schedule={
+        "refresh-stats": {
+            "task": "tasks.refresh_stats_task",
+            "schedule": int(os.getenv("STATS_REFRESH_SECONDS", "30")),
+        },
+        "rotate-api-log-partitions": {
+            "task": "tasks.rotate_api_log_partitions_task",
+            "schedule": 86400,
+        },
+    },
 )
@@ -1,8 +1,12 @@
 """
 Database configuration and session management.
 """
+import logging
 import os
-from sqlalchemy import create_engine
+from datetime import date
+
+import orjson
+from sqlalchemy import create_engine, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
@@ -15,11 +19,48 @@ DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://localhost/cfdi_verifier")
 if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True, pool_size=5, max_overflow=10)
+# JSON columns are encoded and decoded with orjson rather than the stdlib json
+engine = create_engine(
+    DATABASE_URL,
+    pool_pre_ping=True,
+    pool_size=5,
+    max_overflow=10,
+    json_serializer=lambda obj: orjson.dumps(obj).decode(),
+    json_deserializer=orjson.loads,
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+logger = logging.getLogger("cfdi-db")
+
+# Monthly api_logs partitions older than this are dropped
+API_LOG_RETENTION_MONTHS = int(os.getenv("API_LOG_RETENTION_MONTHS", "3"))
+
+# pg_advisory_lock key serializing init_db across processes
+INIT_DB_LOCK_KEY = 7262001
+
+# Columns created as native Postgres enums before models.string_enum made them
+# VARCHAR + CHECK: (table, column, old enum type, CHECK constraint name)
+NATIVE_ENUM_COLUMNS = [
+    ("verifications", "method", "verificationmethod", "ck_verification_method"),
+    ("verifications", "status", "verificationstatus", "ck_verification_status"),
+    ("batches", "status", "verificationstatus", "ck_batch_status"),
+]
+
+# Materialized views behind /stats (Postgres only): name -> (query, unique key).
+# The unique index lets them be refreshed CONCURRENTLY, without blocking reads.
+STATS_VIEWS = {
+    "verification_stats": (
+        "SELECT status,"
+        " CASE WHEN valid THEN 'valid' WHEN NOT valid THEN 'invalid' ELSE 'unknown' END AS validity,"
+        " count(*) AS n"
+        " FROM verifications GROUP BY 1, 2",
+        "status, validity",
+    ),
+    "batch_stats": ("SELECT 1 AS id, count(*) AS total FROM batches", "id"),
+}
+
 
 def get_db():
     """Dependency for FastAPI endpoints."""
@@ -31,5 +72,115 @@ def get_db():
 
 
 def init_db():
-    """Create all tables."""
+    """Create all tables, plus indexes added to existing tables since they were created."""
+    if not stats_views_enabled():
+        create_schema()
+        return
+    # Every API worker runs this at startup; concurrent DDL on the same tables
+    # fails, so workers take turns and the later ones find everything in place
+    with engine.connect() as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": INIT_DB_LOCK_KEY})
+        try:
+            create_schema()
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": INIT_DB_LOCK_KEY})
+
+
+def create_schema():
     Base.metadata.create_all(bind=engine)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+    if stats_views_enabled():
+        with engine.begin() as conn:
+            # sat_response was created as json before it became jsonb
+            conn.execute(text(
+                "DO $$ BEGIN"
+                " IF (SELECT data_type FROM information_schema.columns"
+                "     WHERE table_name = 'verifications' AND column_name = 'sat_response') = 'json' THEN"
+                "   ALTER TABLE verifications ALTER COLUMN sat_response TYPE jsonb USING sat_response::jsonb;"
+                " END IF;"
+                " END $$"
+            ))
+            convert_native_enums(conn)
+            for name, (query, key) in STATS_VIEWS.items():
+                conn.execute(text(f"CREATE MATERIALIZED VIEW IF NOT EXISTS {name} AS {query}"))
+                conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS ux_{name} ON {name} ({key})"))
+        rotate_api_log_partitions()
+
+
+def convert_native_enums(conn):
+    """
+    Turn the native enum columns of databases created before string_enum into
+    VARCHAR + CHECK, in place, then drop the unused types (Postgres only).
+    The /stats views read these columns; create_schema recreates them after.
+    """
+    for table, column, _, constraint in NATIVE_ENUM_COLUMNS:
+        values = ", ".join(f"'{value}'" for value in Base.metadata.tables[table].c[column].type.enums)
+        conn.execute(text(
+            "DO $$ BEGIN"
+            " IF (SELECT data_type FROM information_schema.columns"
+            f"     WHERE table_name = '{table}' AND column_name = '{column}') = 'USER-DEFINED' THEN"
+            f"   DROP MATERIALIZED VIEW IF EXISTS {', '.join(STATS_VIEWS)};"
+            f"   ALTER TABLE {table} ALTER COLUMN {column} TYPE VARCHAR(12) USING {column}::text;"
+            f"   ALTER TABLE {table} ADD CONSTRAINT {constraint} CHECK ({column} IN ({values}));"
+            " END IF;"
+            " END $$"
+        ))
+    for enum_type in sorted({enum_type for _, _, enum_type, _ in NATIVE_ENUM_COLUMNS}):
+        conn.execute(text(f"DROP TYPE IF EXISTS {enum_type}"))
+
+
+def stats_views_enabled() -> bool:
+    return engine.dialect.name == "postgresql"
+
+
+def refresh_stats_views():
+    """Recompute the /stats views; readers keep seeing the old rows meanwhile."""
+    if not stats_views_enabled():
+        return
+    with engine.begin() as conn:
+        for name in STATS_VIEWS:
+            conn.execute(text(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {name}"))
+
+
+def add_months(day: date, months: int) -> date:
+    """First day of the month `months` away from day's month."""
+    month = day.year * 12 + day.month - 1 + months
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def rotate_api_log_partitions(today: date = None):
+    """
+    Make sure api_logs has partitions for this month and the next, and drop
+    the ones older than API_LOG_RETENTION_MONTHS (Postgres only).
+    """
+    if engine.dialect.name != "postgresql":
+        return
+    today = today or date.today()
+    with engine.begin() as conn:
+        partitioned = conn.execute(text(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'api_logs'::regclass"
+        )).first()
+        if not partitioned:
+            logger.warning("api_logs predates partitioning, recreate it to enable monthly rotation")
+            return
+
+        for offset in (0, 1):
+            start = add_months(today, offset)
+            end = add_months(today, offset + 1)
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS api_logs_{start:%Y_%m} PARTITION OF api_logs"
+                f" FOR VALUES FROM ('{start}') TO ('{end}')"
+            ))
+
+        oldest_kept = f"api_logs_{add_months(today, -API_LOG_RETENTION_MONTHS):%Y_%m}"
+        partitions = conn.execute(text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid"
+            " WHERE i.inhparent = 'api_logs'::regclass"
+        )).scalars()
+        for name in partitions:
+            if name < oldest_kept:
+                conn.execute(text(f"DROP TABLE {name}"))
+                logger.info(f"Dropped API log partition {name}")
@@ -0,0 +1,112 @@
+"""
+Redis-backed storage for async job and batch metadata.
+Shared by every API worker; records expire together with Celery results.
+"""
+import json
+import time
+from typing import Optional
+
+# Matches Celery's result_expires
+RECORD_TTL = 86400
+
+# KEYS[1] = record, ARGV = ttl, field, value, ...; atomic so the record can't expire in between
+UPDATE_IF_EXISTS = """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return 0
+end
+redis.call("HSET", KEYS[1], unpack(ARGV, 2))
+redis.call("EXPIRE", KEYS[1], ARGV[1])
+return 1
+"""
+
+
+class RedisStore:
+    """Records kept as Redis hashes, indexed by creation time in a sorted set."""
+
+    def __init__(self, redis, prefix: str, ttl: int = RECORD_TTL):
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+        self.index_key = f"cfdi:{prefix}:by_created"
+
+    def key(self, record_id: str) -> str:
+        return f"cfdi:{self.prefix}:{record_id}"
+
+    async def create(self, record_id: str, record: dict):
+        """
+        Store a new record and index it by creation time.
+        Index entries of records past their TTL are dropped at the same time,
+        so the index stays bounded even if nobody lists the records.
+        """
+        now = time.time()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self.key(record_id), mapping=_encode(record))
+            pipe.expire(self.key(record_id), self.ttl)
+            pipe.zadd(self.index_key, {record_id: now})
+            pipe.zremrangebyscore(self.index_key, "-inf", now - self.ttl)
+            await pipe.execute()
+
+    async def update(self, record_id: str, **fields) -> bool:
+        """
+        Overwrite some fields of an existing record and restart its TTL.
+        Returns False, writing nothing, if the record was deleted or has expired;
+        a plain HSET would bring it back as a partial, unindexed record.
+        """
+        args = [self.ttl]
+        for field, value in _encode(fields).items():
+            args += [field, value]
+        return bool(await self.redis.eval(UPDATE_IF_EXISTS, 1, self.key(record_id), *args))
+
+    async def get(self, record_id: str) -> Optional[dict]:
+        data = await self.redis.hgetall(self.key(record_id))
+        return _decode(data) if data else None
+
+    async def delete(self, record_id: str) -> bool:
+        """Remove a record. Returns False if it did not exist."""
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(self.key(record_id))
+            pipe.zrem(self.index_key, record_id)
+            deleted, _ = await pipe.execute()
+        return bool(deleted)
+
+    async def recent(self, limit: int, fields: Optional[list[str]] = None) -> list[tuple[str, dict]]:
+        """Most recently created records, newest first, optionally only some fields."""
+        record_ids = await self.redis.zrevrange(self.index_key, 0, limit - 1)
+        if not record_ids:
+            return []
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for record_id in record_ids:
+                if fields:
+                    pipe.hmget(self.key(record_id), fields)
+                else:
+                    pipe.hgetall(self.key(record_id))
+            rows = await pipe.execute()
+
+        if fields:
+            rows = [
+                {field: value for field, value in zip(fields, values) if value is not None}
+                for values in rows
+            ]
+
+        records = []
+        expired = []
+        for record_id, data in zip(record_ids, rows):
+            if data:
+                records.append((record_id, _decode(data)))
+            else:
+                expired.append(record_id)
+        if expired:
+            await self.redis.zrem(self.index_key, *expired)
+        return records
+
+    async def count(self) -> int:
+        return await self.redis.zcard(self.index_key)
+
+
+def _encode(record: dict) -> dict:
+    return {field: json.dumps(value) for field, value in record.items()}
+
+
+def _decode(data: dict) -> dict:
+    return {field: json.loads(value) for field, value in data.items()}
@@ -1,14 +1,20 @@
 """
 SQLAlchemy models for CFDI Verifier.
 """
-from datetime import datetime
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, ForeignKey, JSON, Enum as SQLEnum
+from datetime import datetime, timezone
+from sqlalchemy import Column, Identity, Integer, String, Boolean, DateTime, Text, ForeignKey, JSON, Index, Enum as SQLEnum, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 import enum
 
 from database import Base
 
 
+def utcnow() -> datetime:
+    """Current UTC time as a naive datetime, like the stored timestamps (datetime.utcnow is deprecated)."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 class VerificationStatus(str, enum.Enum):
     PENDING = "pending"
     PROCESSING = "processing"
@@ -21,6 +27,16 @@ class VerificationMethod(str, enum.Enum):
     XML = "xml"
 
 
+def string_enum(enum_class, name: str) -> SQLEnum:
+    """
+    Enum stored as a short VARCHAR plus a CHECK constraint instead of a native
+    Postgres enum type, so adding a value doesn't need ALTER TYPE. Member
+    names are stored, as with the native enum before; existing native columns
+    are converted by database.convert_native_enums.
+    """
+    return SQLEnum(enum_class, native_enum=False, length=12, create_constraint=True, name=name)
+
+
 class Verification(Base):
     """Individual CFDI verification record."""
     __tablename__ = "verifications"
@@ -29,18 +45,18 @@ class Verification(Base):
     job_id = Column(String(36), unique=True, index=True, nullable=False)
 
     # Request data
-    method = Column(SQLEnum(VerificationMethod), nullable=False)
+    method = Column(string_enum(VerificationMethod, "ck_verification_method"), nullable=False)
     folio_fiscal = Column(String(36), index=True, nullable=True)
     rfc_emisor = Column(String(13), index=True, nullable=True)
     rfc_receptor = Column(String(13), index=True, nullable=True)
     xml_hash = Column(String(64), nullable=True)  # SHA256 of XML content
 
     # Status
-    status = Column(SQLEnum(VerificationStatus), default=VerificationStatus.PENDING, nullable=False)
+    status = Column(string_enum(VerificationStatus, "ck_verification_status"), default=VerificationStatus.PENDING, nullable=False)
 
     # Results
     valid = Column(Boolean, nullable=True)
-    sat_response = Column(JSON, nullable=True)  # Full SAT response
+    sat_response = Column(JSON(none_as_null=True).with_variant(JSONB(none_as_null=True), "postgresql"), nullable=True)  # Full SAT response
     error_message = Column(Text, nullable=True)
 
     # Webhook
@@ -52,13 +68,29 @@ class Verification(Base):
     batch_index = Column(Integer, nullable=True)
 
     # Timestamps
-    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at = Column(DateTime, default=utcnow, nullable=False)
     started_at = Column(DateTime, nullable=True)
     completed_at = Column(DateTime, nullable=True)
 
     # Relationship
     batch = relationship("Batch", back_populates="verifications")
 
+    __table_args__ = (
+        # Recent-result lookup for a CFDI (see recent_folio_result)
+        Index("ix_verif_lookup", "folio_fiscal", "rfc_emisor", "rfc_receptor", "completed_at"),
+        # Same for an uploaded XML (see recent_xml_result)
+        Index("ix_verif_xml_lookup", "xml_hash", "completed_at"),
+        # Batch status and per-item updates
+        Index("ix_verif_batch", "batch_id", "batch_index"),
+        Index("ix_verif_batch_status", "batch_id", "status"),
+        # /history filters, newest first; (created_at, id) is the keyset cursor
+        Index("ix_verif_created_id", "created_at", "id"),
+        Index("ix_verif_rfc_emisor_created", "rfc_emisor", "created_at"),
+        Index("ix_verif_rfc_receptor_created", "rfc_receptor", "created_at"),
+        Index("ix_verif_status_created", "status", "created_at"),
+        Index("ix_verif_valid_created", "valid", "created_at", postgresql_where=text("valid IS NOT NULL")),
+    )
+
     def __repr__(self):
         return f"<Verification {self.job_id} - {self.status}>"
 
@@ -76,7 +108,7 @@ class Batch(Base):
     failed_count = Column(Integer, default=0)
 
     # Status
-    status = Column(SQLEnum(VerificationStatus), default=VerificationStatus.PENDING, nullable=False)
+    status = Column(string_enum(VerificationStatus, "ck_batch_status"), default=VerificationStatus.PENDING, nullable=False)
 
     # Webhook
     webhook_url = Column(String(500), nullable=True)
@@ -86,7 +118,7 @@ class Batch(Base):
     celery_group_id = Column(String(36), nullable=True)
 
     # Timestamps
-    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at = Column(DateTime, default=utcnow, nullable=False)
     completed_at = Column(DateTime, nullable=True)
 
     # Relationship
@@ -97,10 +129,14 @@ class Batch(Base):
 
 
 class APILog(Base):
-    """API request/response logging."""
+    """
+    API request/response logging.
+    Range-partitioned by month on Postgres (see database.rotate_api_log_partitions),
+    so old months are dropped whole; the partition key must be part of the primary key.
+    """
     __tablename__ = "api_logs"
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, Identity(), primary_key=True)
 
     # Request info
     endpoint = Column(String(100), nullable=False)
@@ -116,8 +152,10 @@ class APILog(Base):
     user_agent = Column(String(500), nullable=True)
 
     # Timing
-    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at = Column(DateTime, default=utcnow, primary_key=True)
     duration_ms = Column(Integer, nullable=True)
 
+    __table_args__ = {"postgresql_partition_by": "RANGE (created_at)"}
+
     def __repr__(self):
         return f"<APILog {self.method} {self.endpoint} - {self.response_status}>"
@@ -0,0 +1,153 @@
+"""
+Plain-HTTP access to the SAT verification form.
+The page is an ASP.NET WebForms form, so a verification is one GET for its
+hidden state fields and CAPTCHA, then one POST, without a browser. Markup
+that doesn't look like the known form raises SatFormError, so callers can
+fall back to Playwright.
+
+results_from_page turns the result tables into the API's result dict; it is
+shared by this path and the browser ones (API and workers).
+"""
+import re
+from urllib.parse import urljoin
+
+import lxml.etree
+import lxml.html
+
+FIELD_PREFIX = "ctl00$MainContent$"
+CAPTCHA_IMG_ID = "ctl00_MainContent_ImgCaptcha"
+
+# Compiled once at import, reused for every page
+XP_HIDDEN_FIELDS = lxml.etree.XPath('//input[@type="hidden"][@name]')
+XP_CAPTCHA_SRC = lxml.etree.XPath(f'//img[@id="{CAPTCHA_IMG_ID}"]/@src')
+XP_VIEWSTATE = lxml.etree.XPath('//input[@name="__VIEWSTATE"]')
+XP_ROWS = lxml.etree.XPath("//table//tr")
+XP_CELLS = lxml.etree.XPath("./td")
+
+
+# Every outcome marker in one scan of the page text; only "incorrecto" varies in case
+STATUS_RE = re.compile(r"Vigente|Cancelado|CFDI válido|(?i:incorrecto)")
+
+
+class SatFormError(Exception):
+    """The SAT page didn't have the expected form or result markup."""
+
+
+def parse_form(html: str, base_url: str) -> tuple[dict, str]:
+    """Hidden ASP.NET state fields of the form and the absolute CAPTCHA image URL."""
+    doc = lxml.html.fromstring(html)
+    fields = {
+        field.get("name"): field.get("value", "")
+        for field in XP_HIDDEN_FIELDS(doc)
+    }
+    if "__VIEWSTATE" not in fields:
+        raise SatFormError("No __VIEWSTATE on the SAT page")
+
+    src = XP_CAPTCHA_SRC(doc)
+    if not src:
+        raise SatFormError("No CAPTCHA image on the SAT page")
+    return fields, urljoin(base_url, src[0])
+
+
+def folio_form_data(fields: dict, folio_fiscal: str, rfc_emisor: str,
+                    rfc_receptor: str, captcha_text: str) -> dict:
+    """POST body for the Folio Fiscal search, as the 'Verificar CFDI' button sends it."""
+    return {
+        **fields,
+        FIELD_PREFIX + "TxtUUID": folio_fiscal,
+        FIELD_PREFIX + "TxtRfcEmisor": rfc_emisor,
+        FIELD_PREFIX + "TxtRfcReceptor": rfc_receptor,
+        FIELD_PREFIX + "TxtCaptchaNumbers": captcha_text,
+        FIELD_PREFIX + "BtnBusqueda": "Verificar CFDI",
+    }
+
+
+def status_flags(text: str) -> dict:
+    """Outcome markers found in the visible text of a submitted SAT page."""
+    found = {marker.lower() for marker in STATUS_RE.findall(text)}
+    return {
+        "vigente": "vigente" in found,
+        "cancelado": "cancelado" in found,
+        "valido": "cfdi válido" in found,
+        "incorrecto": "incorrecto" in found,
+    }
+
+
+def parse_result(html: str) -> dict:
+    """
+    Status flags and table cell texts of a submitted form, in the same shape
+    as the browser paths' read_page. A page with neither, such as the form
+    re-rendered with validation errors, raises SatFormError rather than
+    passing for a CFDI that wasn't found.
+    """
+    doc = lxml.html.fromstring(html)
+    if not XP_VIEWSTATE(doc):
+        raise SatFormError("SAT answered with an unknown page")
+
+    body = doc.find("body")
+    text = (body if body is not None else doc).text_content()
+    flags = status_flags(text)
+    rows = [
+        [cell.text_content().strip() for cell in XP_CELLS(row)]
+        for row in XP_ROWS(doc)
+    ]
+    if not any(flags.values()) and not any(row_matches(row, cells) for cells in rows for row in RESULT_ROWS):
+        raise SatFormError("SAT answered without a verification outcome")
+    return {**flags, "rows": rows}
+
+
+# ---------- Result tables ----------
+
+RFC_RE = re.compile(r"[A-ZÑ&]{3,4}\d{6}[A-Z0-9]{3}$")
+UUID_RE = re.compile(r"[0-9A-F]{8}-[0-9A-F]{4}-[0-9A-F]{4}-[0-9A-F]{4}-[0-9A-F]{12}$", re.IGNORECASE)
+DATETIME_RE = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}")
+MONEY_RE = re.compile(r"\$")
+CANCELADO_RE = re.compile(r".*Cancelado")
+
+# Each SAT result row, recognized by patterns on its leading cells:
+# (result fields for the first cells, pattern per checked cell)
+RESULT_ROWS = [
+    (("rfc_emisor", "nombre_emisor", "rfc_receptor", "nombre_receptor"), (RFC_RE,)),
+    (("folio_fiscal", "fecha_expedicion", "fecha_certificacion", "pac_certificador"), (UUID_RE, DATETIME_RE)),
+    (("total", "efecto", "estado"), (MONEY_RE,)),
+    (("estatus_cancelacion", "fecha_cancelacion"), (CANCELADO_RE, DATETIME_RE)),
+]
+
+RESULT_FIELDS = (
+    "folio_fiscal", "rfc_emisor", "nombre_emisor", "rfc_receptor", "nombre_receptor",
+    "fecha_expedicion", "fecha_certificacion", "pac_certificador",
+    "total", "efecto", "estado", "estatus_cancelacion", "fecha_cancelacion",
+)
+
+
+def row_matches(row, cells: list) -> bool:
+    """True if cells are the SAT result row described by a RESULT_ROWS entry."""
+    fields, patterns = row
+    return len(cells) >= len(fields) and all(p.match(c) for p, c in zip(patterns, cells))
+
+
+def results_from_page(page_data: dict) -> dict:
+    """Verification results from a SAT page's status flags and table cell texts."""
+    results = {"valid": False, "message": "", **dict.fromkeys(RESULT_FIELDS, "")}
+
+    # Vigente or Cancelado both mean the CFDI exists/existed
+    if page_data["vigente"]:
+        results["valid"] = True
+        results["message"] = "CFDI vigente - válido y activo"
+    elif page_data["cancelado"]:
+        results["valid"] = True
+        results["message"] = "CFDI cancelado"
+    else:
+        results["message"] = "CFDI no encontrado o inválido"
+
+    pending = list(RESULT_ROWS)
+    for cells in page_data["rows"]:
+        for row in pending:
+            if row_matches(row, cells):
+                results.update(zip(row[0], cells))
+                pending.remove(row)  # Each row appears once; the first match wins
+                break
+        if not pending:
+            break
+
+    return results
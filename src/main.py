@@ -3,114 +3,253 @@ CFDI Verifier Apify Actor
 Verifies Mexican digital tax invoices (CFDI) against SAT's official verification service.
 """
 
+import asyncio
 import base64
 import os
-import tempfile
-from pathlib import Path
+import re
+from urllib.parse import urljoin
+from contextlib import asynccontextmanager
 
 import httpx
 from apify import Actor
-from playwright.async_api import async_playwright
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError, async_playwright
 from twocaptcha import TwoCaptcha
 
 
-async def solve_captcha_with_2captcha(image_bytes: bytes) -> str:
-    """Use 2Captcha service to solve the CAPTCHA."""
-    api_key = os.getenv("TWOCAPTCHA_API_KEY")
-    if not api_key:
-        raise ValueError("TWOCAPTCHA_API_KEY environment variable not set")
+SAT_URL = "https://verificacfdi.facturaelectronica.sat.gob.mx/"
+CAPTCHA_SELECTOR = "#ctl00_MainContent_ImgCaptchaXml"
+CAPTCHA_INPUT_SELECTOR = "#ctl00_MainContent_TxtCaptchaNumbersXml"
+# CSS instead of get_by_role, which walks the accessibility tree
+SUBMIT_SELECTOR = 'input[type="submit"][value="Verificar CFDI"]:visible'
+
+# Not needed to fill the form or read the results (same filter as the API and workers)
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media", "stylesheet"}
+BLOCKED_HOSTS = ("google-analytics.com", "googletagmanager.com", "doubleclick.net")
+
+# Playwright already skips the sandbox, /dev/shm, extensions and background
+# networking; the GPU process is the one thing left to turn off
+CHROMIUM_ARGS = ["--disable-gpu"]
+
+CAPTCHA_READY_JS = """sel => {
+    const img = document.querySelector(sel);
+    return !!img && img.complete && img.naturalWidth > 0;
+}"""
+
+
+# Any of these in the visible text means SAT has answered the submission
+OUTCOME_JS = "() => !!document.body && /Vigente|Cancelado|incorrecto|válido/i.test(document.body.innerText)"
+
+
+async def submit_and_wait(page):
+    """Click 'Verificar CFDI' and wait for SAT's answer instead of sleeping."""
+    async with page.expect_response(lambda r: r.request.method == "POST" and "verificacfdi" in r.url):
+        await page.locator(SUBMIT_SELECTOR).click()
+    try:
+        await page.wait_for_function(OUTCOME_JS, timeout=2000)
+    except PlaywrightTimeoutError:
+        pass  # No known marker (e.g. CFDI not found), the caller classifies the page
+
+
+async def fetch_captcha(page) -> bytes:
+    """
+    The CAPTCHA image as SAT encoded it, fetched with the page's cookies instead
+    of rasterizing the element. Falls back to a screenshot if the fetch fails.
+    """
+    # Let the browser's own load finish first: SAT keeps the code of the last image it served
+    await page.wait_for_function(CAPTCHA_READY_JS, arg=CAPTCHA_SELECTOR)
+    captcha_img = page.locator(CAPTCHA_SELECTOR)
+    src = await captcha_img.get_attribute("src")
+    if src and src.startswith("data:"):
+        return base64.b64decode(src.partition(",")[2])
+    if src:
+        response = await page.request.get(urljoin(page.url, src))
+        if response.ok:
+            return await response.body()
+    return await captcha_img.screenshot()
+
 
-    solver = TwoCaptcha(api_key)
-    base64_image = base64.standard_b64encode(image_bytes).decode("utf-8")
-    result = solver.normal(base64_image)
-    return result["code"]
+_solver = None
 
 
-async def verify_cfdi(xml_content: str, headless: bool = True, max_retries: int = 3) -> dict:
+def get_solver() -> TwoCaptcha:
+    """The 2Captcha client, created once per run (it keeps no per-request state)."""
+    global _solver
+    if _solver is None:
+        api_key = os.getenv("TWOCAPTCHA_API_KEY")
+        if not api_key:
+            raise ValueError("TWOCAPTCHA_API_KEY environment variable not set")
+        _solver = TwoCaptcha(api_key)
+    return _solver
+
+
+def _solve_blocking(image_bytes: bytes) -> str:
+    """Submit the CAPTCHA to 2Captcha and poll until it's solved (blocks for 10-20s)."""
+    base64_image = base64.b64encode(image_bytes).decode("ascii")
+    return get_solver().normal(base64_image)["code"]
+
+
+async def solve_captcha_with_2captcha(image_bytes: bytes) -> str:
+    """Use 2Captcha service to solve the CAPTCHA, off the event loop so other CFDIs proceed."""
+    return await asyncio.to_thread(_solve_blocking, image_bytes)
+
+
+# One browser for the whole run, launched on first use
+_playwright = None
+_browser = None
+_browser_lock = asyncio.Lock()
+
+
+async def get_browser(headless: bool = True):
+    """Return the shared browser, launching it (again, if it crashed) as needed."""
+    global _playwright, _browser
+    async with _browser_lock:
+        if _browser is None or not _browser.is_connected():
+            if _playwright is None:
+                _playwright = await async_playwright().start()
+            _browser = await _playwright.chromium.launch(headless=headless, args=CHROMIUM_ARGS)
+        return _browser
+
+
+async def close_browser():
+    """Close the shared browser and stop Playwright."""
+    global _playwright, _browser
+    if _browser is not None:
+        await _browser.close()
+        _browser = None
+    if _playwright is not None:
+        await _playwright.stop()
+        _playwright = None
+
+
+async def block_assets(route):
+    """Abort images, fonts, styles and trackers, but never the CAPTCHA."""
+    request = route.request
+    url = request.url.lower()
+    if "captcha" not in url and (
+        request.resource_type in BLOCKED_RESOURCE_TYPES or any(host in url for host in BLOCKED_HOSTS)
+    ):
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+class PagePool:
+    """At most size pages open at once on the shared browser, each in a fresh context."""
+
+    def __init__(self, headless: bool, size: int):
+        self.headless = headless
+        self._slots = asyncio.Semaphore(size)
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Wait for a free slot and yield a page; its context is closed on exit."""
+        async with self._slots:
+            # Fresh context per verification: no cookies or SAT session carried over
+            browser = await get_browser(self.headless)
+            context = await browser.new_context()
+            try:
+                await context.route("**/*", block_assets)
+                yield await context.new_page()
+            finally:
+                await context.close()
+
+
+async def verify_cfdi(page, xml_content: str, max_retries: int = 3) -> dict:
     """
     Verify a CFDI XML against SAT's verification service.
 
     Args:
+        page: Page to run the verification on
         xml_content: The XML content as a string
-        headless: Run browser in headless mode
         max_retries: Number of times to retry if CAPTCHA fails
 
     Returns:
         dict with verification results
     """
-    # Write XML to temp file
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".xml", delete=False) as f:
-        f.write(xml_content)
-        xml_path = f.name
+    # Handed to the file chooser from memory, no temp file to write or clean up
+    xml_file = {"name": "cfdi.xml", "mimeType": "application/xml", "buffer": xml_content.encode("utf-8")}
 
-    try:
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=headless)
-            page = await browser.new_page()
+    for attempt in range(max_retries):
+        try:
+            Actor.log.info(f"Attempt {attempt + 1}: Loading SAT verification page...")
+            await page.goto(SAT_URL, wait_until="domcontentloaded")
+
+            # Select XML file consultation mode
+            await page.get_by_role("radio", name="Consulta por archivo XML").click()
+            await page.wait_for_selector(CAPTCHA_SELECTOR, state="visible")
+
+            # Upload the XML file
+            Actor.log.info("Uploading XML file...")
+            async with page.expect_file_chooser() as fc_info:
+                await page.get_by_text("Buscar").click()
+            file_chooser = await fc_info.value
+            await file_chooser.set_files(xml_file)
+
+            # Get CAPTCHA image and solve it
+            Actor.log.info("Solving CAPTCHA with 2Captcha...")
+            captcha_bytes = await fetch_captcha(page)
+            captcha_task = asyncio.create_task(solve_captcha_with_2captcha(captcha_bytes))
+
+            # Make sure the form is ready for the answer while it's being solved
+            captcha_input = page.locator(CAPTCHA_INPUT_SELECTOR)
+            try:
+                await captcha_input.wait_for(state="visible")
+            except BaseException:
+                captcha_task.cancel()
+                raise
 
-            for attempt in range(max_retries):
-                try:
-                    Actor.log.info(f"Attempt {attempt + 1}: Loading SAT verification page...")
-                    await page.goto("https://verificacfdi.facturaelectronica.sat.gob.mx/")
-                    await page.wait_for_load_state("networkidle")
-
-                    # Select XML file consultation mode
-                    await page.get_by_role("radio", name="Consulta por archivo XML").click()
-                    await page.wait_for_timeout(500)
-
-                    # Upload the XML file
-                    Actor.log.info("Uploading XML file...")
-                    async with page.expect_file_chooser() as fc_info:
-                        await page.get_by_text("Buscar").click()
-                    file_chooser = await fc_info.value
-                    await file_chooser.set_files(xml_path)
-
-                    await page.wait_for_timeout(500)
-
-                    # Get CAPTCHA image and solve it
-                    Actor.log.info("Solving CAPTCHA with 2Captcha...")
-                    captcha_img = page.locator("#ctl00_MainContent_ImgCaptchaXml")
-                    captcha_bytes = await captcha_img.screenshot()
-
-                    captcha_text = await solve_captcha_with_2captcha(captcha_bytes)
-                    Actor.log.info(f"CAPTCHA solution: {captcha_text}")
-
-                    # Enter CAPTCHA
-                    await page.locator("#ctl00_MainContent_TxtCaptchaNumbersXml").fill(captcha_text)
-
-                    # Submit
-                    Actor.log.info("Submitting verification request...")
-                    await page.get_by_role("button", name="Verificar CFDI").click()
-                    await page.wait_for_timeout(2000)
-
-                    # Check for results or error
-                    page_content = await page.content()
-
-                    if "CFDI válido" in page_content or "Válido" in page_content:
-                        results = await extract_results(page)
-                        await browser.close()
-                        return results
-                    elif "incorrecto" in page_content.lower():
-                        Actor.log.warning(f"CAPTCHA incorrect, retrying... ({attempt + 1}/{max_retries})")
-                        await page.reload()
-                        continue
-                    else:
-                        results = await extract_results(page)
-                        await browser.close()
-                        return results
+            captcha_text = await captcha_task
+            Actor.log.info(f"CAPTCHA solution: {captcha_text}")
 
-                except Exception as e:
-                    Actor.log.error(f"Error on attempt {attempt + 1}: {e}")
-                    if attempt < max_retries - 1:
-                        continue
-                    raise
+            # Enter CAPTCHA
+            await captcha_input.fill(captcha_text)
+
+            # Submit
+            Actor.log.info("Submitting verification request...")
+            await submit_and_wait(page)
 
-            await browser.close()
-            raise Exception(f"Failed to verify CFDI after {max_retries} attempts")
+            # Check for results or error, one scan over the HTML
+            markers = {m.lower() for m in STATUS_RE.findall(await page.content())}
 
-    finally:
-        # Clean up temp file
-        Path(xml_path).unlink(missing_ok=True)
+            if "incorrecto" in markers and markers.isdisjoint(FOUND_MARKERS):
+                Actor.log.warning(f"CAPTCHA incorrect, retrying... ({attempt + 1}/{max_retries})")
+                continue  # The next attempt navigates to the form again
+            return await extract_results(page)
+
+        except Exception as e:
+            Actor.log.error(f"Error on attempt {attempt + 1}: {e}")
+            if attempt < max_retries - 1:
+                continue
+            raise
+
+    raise Exception(f"Failed to verify CFDI after {max_retries} attempts")
+
+
+# Success flag and every table's cell texts, grouped by table
+EXTRACT_JS = """() => ({
+    valido: document.body.innerText.toLowerCase().includes('cfdi válido'),
+    tables: Array.from(document.querySelectorAll('table')).map(t =>
+        Array.from(t.querySelectorAll('tr')).map(
+            r => Array.from(r.querySelectorAll('td')).map(c => c.innerText.trim())
+        )
+    ),
+})"""
+
+# SAT's answer markers; any of FOUND_MARKERS means the CFDI was looked up
+STATUS_RE = re.compile(r"vigente|cancelado|incorrecto|v[aá]lido", re.IGNORECASE)
+FOUND_MARKERS = {"vigente", "cancelado", "válido", "valido"}
+
+DATETIME_RE = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}")
+
+
+# (lowercase label, result field) of the validation table rows
+VALIDATION_LABELS = (
+    ("folio fiscal", "folio_fiscal"),
+    ("rfc emisor", "rfc_emisor"),
+    ("rfc receptor", "rfc_receptor"),
+    ("sello cfdi", "sello_cfdi"),
+    ("sello del timbre fiscal", "sello_sat"),
+)
 
 
 async def extract_results(page) -> dict:
@@ -137,103 +276,87 @@ async def extract_results(page) -> dict:
     }
 
     try:
-        # Check for success message
-        if await page.locator("text=CFDI válido").count() > 0:
-            results["valid"] = True
-            results["message"] = "CFDI válido almacenado en los controles del SAT"
-
-        # Extract from first validation table
-        validation_rows = [
-            ("Folio Fiscal", "folio_fiscal"),
-            ("Rfc emisor", "rfc_emisor"),
-            ("Rfc receptor", "rfc_receptor"),
-            ("Sello CFDI", "sello_cfdi"),
-            ("Sello del timbre fiscal", "sello_sat"),
-        ]
-
-        for label, key in validation_rows:
-            try:
-                row = page.locator(f"tr:has(td:has-text('{label}'))")
-                if await row.count() > 0:
-                    cells = row.first.locator("td")
-                    if await cells.count() >= 2:
-                        results[key] = (await cells.nth(1).inner_text()).strip()
-            except Exception:
-                pass
-
-        # Extract emisor/receptor info from second table
-        try:
-            # Find the row with RFC and name data
-            data_rows = page.locator("table").nth(1).locator("tr")
-            row_count = await data_rows.count()
-
-            for i in range(row_count):
-                row = data_rows.nth(i)
-                cells = row.locator("td")
-                cell_count = await cells.count()
-
-                if cell_count >= 4:
-                    texts = []
-                    for j in range(cell_count):
-                        text = (await cells.nth(j).inner_text()).strip()
-                        texts.append(text)
-
-                    # Check if this looks like the emisor/receptor row
-                    if len(texts) >= 4 and texts[0] and not texts[0].startswith("RFC"):
-                        if not results["rfc_emisor"] or results["rfc_emisor"] == texts[0]:
-                            results["rfc_emisor"] = texts[0]
-                            results["nombre_emisor"] = texts[1]
-                            results["rfc_receptor"] = texts[2]
-                            results["nombre_receptor"] = texts[3]
-                            break
-        except Exception:
-            pass
-
-        # Extract terceros info
-        try:
-            terceros_row = page.locator("tr:has(td:has-text('SACE'))")
-            if await terceros_row.count() > 0:
-                text = await terceros_row.first.inner_text()
-                parts = text.split()
-                if len(parts) >= 2:
-                    results["rfc_terceros"] = parts[0]
-                    results["nombre_terceros"] = " ".join(parts[1:]).replace("\t", " ").strip()
-        except Exception:
-            pass
-
-        # Extract dates and PAC
-        try:
-            # Look for the row with dates
-            date_row = page.locator(f"tr:has(td:has-text('2026-'))")
-            if await date_row.count() > 0:
-                cells = date_row.first.locator("td")
-                if await cells.count() >= 4:
-                    results["folio_fiscal"] = (await cells.nth(0).inner_text()).strip()
-                    results["fecha_expedicion"] = (await cells.nth(1).inner_text()).strip()
-                    results["fecha_certificacion"] = (await cells.nth(2).inner_text()).strip()
-                    results["pac_certificador"] = (await cells.nth(3).inner_text()).strip()
-        except Exception:
-            pass
-
-        # Extract total, efecto, estado
-        try:
-            total_row = page.locator("tr:has(td:has-text('$'))")
-            if await total_row.count() > 0:
-                cells = total_row.first.locator("td")
-                if await cells.count() >= 4:
-                    results["total"] = (await cells.nth(0).inner_text()).strip()
-                    results["efecto"] = (await cells.nth(1).inner_text()).strip()
-                    results["estado"] = (await cells.nth(2).inner_text()).strip()
-                    results["estatus_cancelacion"] = (await cells.nth(3).inner_text()).strip()
-        except Exception:
-            pass
-
+        # Everything in one round trip; the row matching below runs in Python
+        page_data = await page.evaluate(EXTRACT_JS)
     except Exception as e:
         Actor.log.warning(f"Error extracting results: {e}")
+        return results
+
+    if page_data["valido"]:
+        results["valid"] = True
+        results["message"] = "CFDI válido almacenado en los controles del SAT"
+
+    tables = page_data["tables"]
+    rows = [cells for table in tables for cells in table]
+
+    def first_row(predicate):
+        return next((cells for cells in rows if any(predicate(c) for c in cells)), None)
+
+    # Validation table: one pass for all labels, each row lowercased once.
+    # The first row mentioning a label holds its value in the second cell.
+    pending = list(VALIDATION_LABELS)
+    for cells in rows:
+        lowered = [c.lower() for c in cells]
+        for label, key in list(pending):
+            if any(label in c for c in lowered):
+                pending.remove((label, key))
+                if len(cells) >= 2:
+                    results[key] = cells[1]
+        if not pending:
+            break
+
+    # Extract emisor/receptor info from second table
+    for texts in tables[1] if len(tables) > 1 else []:
+        # Check if this looks like the emisor/receptor row
+        if len(texts) >= 4 and texts[0] and not texts[0].startswith("RFC"):
+            if not results["rfc_emisor"] or results["rfc_emisor"] == texts[0]:
+                results["rfc_emisor"] = texts[0]
+                results["nombre_emisor"] = texts[1]
+                results["rfc_receptor"] = texts[2]
+                results["nombre_receptor"] = texts[3]
+                break
+
+    # Extract terceros info
+    cells = first_row(lambda c: "SACE" in c)
+    if cells:
+        parts = " ".join(cells).split()
+        if len(parts) >= 2:
+            results["rfc_terceros"] = parts[0]
+            results["nombre_terceros"] = " ".join(parts[1:])
+
+    # Extract dates and PAC
+    cells = first_row(DATETIME_RE.search)
+    if cells and len(cells) >= 4:
+        results["folio_fiscal"] = cells[0]
+        results["fecha_expedicion"] = cells[1]
+        results["fecha_certificacion"] = cells[2]
+        results["pac_certificador"] = cells[3]
+
+    # Extract total, efecto, estado
+    cells = first_row(lambda c: "$" in c)
+    if cells and len(cells) >= 4:
+        results["total"] = cells[0]
+        results["efecto"] = cells[1]
+        results["estado"] = cells[2]
+        results["estatus_cancelacion"] = cells[3]
 
     return results
 
 
+BASE64_RE = re.compile(r"[A-Za-z0-9+/=\s]+")
+
+
+def decode_xml_content(content: str) -> str:
+    """Inline XML as given, or decoded if it's base64."""
+    # XML starts with '<'; only strings that look like base64 are worth decoding
+    if content.lstrip().startswith("<") or not BASE64_RE.fullmatch(content[:256]):
+        return content
+    try:
+        return base64.b64decode("".join(content.split()), validate=True).decode("utf-8")
+    except ValueError:
+        return content  # Not base64 after all, use as-is
+
+
 async def main() -> None:
     """Main entry point for the Apify actor."""
     async with Actor:
@@ -245,6 +368,7 @@ async def main() -> None:
         xml_files = actor_input.get("xmlFiles", [])
         max_retries = actor_input.get("maxRetries", 3)
         headless = actor_input.get("headless", True)
+        concurrency = max(1, actor_input.get("concurrency", 3))
 
         # Collect all XML contents to process
         xml_items = []
@@ -252,68 +376,66 @@ async def main() -> None:
         if xml_content:
             xml_items.append({"content": xml_content, "source": "input"})
 
+        # (source, url) of every download, fetched together below
+        downloads = []
         if xml_url:
-            Actor.log.info(f"Downloading XML from: {xml_url}")
-            async with httpx.AsyncClient() as client:
-                response = await client.get(xml_url)
-                response.raise_for_status()
-                xml_items.append({"content": response.text, "source": xml_url})
+            downloads.append((xml_url, xml_url))
 
         for item in xml_files:
             if item.get("url"):
-                Actor.log.info(f"Downloading XML from: {item['url']}")
-                async with httpx.AsyncClient() as client:
-                    response = await client.get(item["url"])
-                    response.raise_for_status()
-                    xml_items.append({
-                        "content": response.text,
-                        "source": item.get("filename") or item["url"]
-                    })
+                downloads.append((item.get("filename") or item["url"], item["url"]))
             elif item.get("content"):
-                # Check if base64 encoded
-                content = item["content"]
-                try:
-                    content = base64.b64decode(content).decode("utf-8")
-                except Exception:
-                    pass  # Not base64, use as-is
                 xml_items.append({
-                    "content": content,
+                    "content": decode_xml_content(item["content"]),
                     "source": item.get("filename") or "inline"
                 })
 
+        if downloads:
+            Actor.log.info(f"Downloading {len(downloads)} XML file(s)...")
+            # One pooled client, so repeated hosts reuse their connections
+            async with httpx.AsyncClient(
+                http2=True,
+                timeout=30,
+                limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+            ) as client:
+                responses = await asyncio.gather(*[client.get(url) for _, url in downloads])
+            for (source, _), response in zip(downloads, responses):
+                response.raise_for_status()
+                xml_items.append({"content": response.text, "source": source})
+
         if not xml_items:
             raise ValueError("No XML content provided. Use xmlContent, xmlUrl, or xmlFiles.")
 
-        Actor.log.info(f"Processing {len(xml_items)} XML file(s)...")
+        Actor.log.info(f"Processing {len(xml_items)} XML file(s), {concurrency} at a time...")
 
-        # Process each XML
-        for i, item in enumerate(xml_items):
-            Actor.log.info(f"Verifying CFDI {i + 1}/{len(xml_items)}: {item['source']}")
+        pool = PagePool(headless, concurrency)
 
-            try:
-                results = await verify_cfdi(
-                    xml_content=item["content"],
-                    headless=headless,
-                    max_retries=max_retries
-                )
-                results["source"] = item["source"]
-
-                # Push to dataset
-                await Actor.push_data(results)
-
-                Actor.log.info(f"CFDI {i + 1} verified: {'VALID' if results['valid'] else 'INVALID'}")
-
-            except Exception as e:
-                Actor.log.error(f"Failed to verify CFDI {i + 1}: {e}")
-                await Actor.push_data({
-                    "valid": False,
-                    "error": str(e),
-                    "source": item["source"]
-                })
+        async def verify_item(i: int, item: dict) -> dict:
+            async with pool.acquire() as page:
+                Actor.log.info(f"Verifying CFDI {i + 1}/{len(xml_items)}: {item['source']}")
+                try:
+                    results = await verify_cfdi(page, item["content"], max_retries=max_retries)
+                    results["source"] = item["source"]
+                    Actor.log.info(f"CFDI {i + 1} verified: {'VALID' if results['valid'] else 'INVALID'}")
+                    return results
+                except Exception as e:
+                    Actor.log.error(f"Failed to verify CFDI {i + 1}: {e}")
+                    return {
+                        "valid": False,
+                        "error": str(e),
+                        "source": item["source"]
+                    }
+
+        # Verify up to concurrency CFDIs at once, pushing each result as soon as it's ready
+        try:
+            tasks = [verify_item(i, item) for i, item in enumerate(xml_items)]
+            for next_result in asyncio.as_completed(tasks):
+                await Actor.push_data(await next_result)
+        finally:
+            await close_browser()
 
         Actor.log.info("Done!")
 
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
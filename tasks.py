@@ -3,168 +3,661 @@ Celery tasks for CFDI verification.
 """
 import asyncio
 import base64
+import concurrent.futures
 import logging
 import os
-import tempfile
-from datetime import datetime
-from pathlib import Path
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from urllib.parse import urljoin
 
 import httpx
-from playwright.sync_api import sync_playwright
-from twocaptcha import TwoCaptcha
-
-from celery_app import celery_app
-from database import SessionLocal
-from models import Verification, Batch, VerificationStatus
+import redis
+from celery import states
+from celery.signals import task_postrun, worker_process_shutdown, worker_ready, worker_shutdown
+from celery.worker import state as worker_state
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+from sqlalchemy import func, select, update
+
+import captcha_model
+import sat_form
+from browser_manager import BLOCK_ASSETS, block_assets, close_browser, get_browser, retire_browser
+from celery_app import celery_app, REDIS_URL, VERIFY_TIMEOUT
+from database import SessionLocal, refresh_stats_views, rotate_api_log_partitions
+from models import Verification, Batch, VerificationStatus, utcnow
 
 logger = logging.getLogger("cfdi-tasks")
 logging.basicConfig(level=logging.INFO)
+# httpx logs every request URL at INFO, which includes the 2Captcha key on polls
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# Batch items verified per Celery task
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "20"))
+
+# Seconds a chunk waits for its items; the ones still pending are failed
+BATCH_CHUNK_TIMEOUT = BATCH_CHUNK_SIZE * 90
 
 
 def update_verification_status(batch_id: str, item_index: int, status: VerificationStatus,
                                 result: dict = None, error: str = None):
-    """Update verification record in database."""
+    """
+    Update one batch item's record, and the batch counters if it finished.
+    Plain UPDATEs with relative increments, so concurrent items don't overwrite each other's counts.
+    """
+    db = SessionLocal()
+    try:
+        batch_pk = select(Batch.id).where(Batch.batch_id == batch_id).scalar_subquery()
+        now = utcnow()
+
+        values = {"status": status}
+        if status == VerificationStatus.PROCESSING:
+            values["started_at"] = now
+        elif status in [VerificationStatus.COMPLETED, VerificationStatus.FAILED]:
+            values["completed_at"] = now
+        if result:
+            values["valid"] = result.get("valid", False)
+            values["sat_response"] = result
+        if error:
+            values["error_message"] = error
+
+        updated = db.execute(
+            update(Verification)
+            .where(Verification.batch_id == batch_pk, Verification.batch_index == item_index)
+            .values(**values)
+        ).rowcount
+
+        if updated and status in [VerificationStatus.COMPLETED, VerificationStatus.FAILED]:
+            db.execute(
+                update(Batch)
+                .where(Batch.batch_id == batch_id)
+                .values(
+                    completed_count=Batch.completed_count + int(status == VerificationStatus.COMPLETED),
+                    failed_count=Batch.failed_count + int(status == VerificationStatus.FAILED),
+                )
+            )
+            db.execute(
+                update(Batch)
+                .where(
+                    Batch.batch_id == batch_id,
+                    Batch.completed_count + Batch.failed_count >= Batch.total_items,
+                    Batch.completed_at.is_(None),
+                )
+                .values(status=VerificationStatus.COMPLETED, completed_at=now)
+            )
+
+        db.commit()
+        if updated:
+            logger.info(f"Updated verification for batch {batch_id}, item {item_index}: {status}")
+    except Exception as e:
+        logger.error(f"DB error updating verification: {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+
+def mark_chunk_processing(batch_id: str, offset: int, count: int):
+    """Mark a contiguous run of batch items as processing in one UPDATE."""
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(Verification)
+            .where(
+                Verification.batch_id == select(Batch.id).where(Batch.batch_id == batch_id).scalar_subquery(),
+                Verification.batch_index >= offset,
+                Verification.batch_index < offset + count,
+            )
+            .values(status=VerificationStatus.PROCESSING, started_at=utcnow())
+        )
+        db.commit()
+    except Exception as e:
+        logger.error(f"DB error marking chunk as processing: {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+
+def save_chunk_results(batch_id: str, offset: int, results: list):
+    """Store a chunk's results and bump the batch counters in a single commit."""
     db = SessionLocal()
     try:
-        # Find the batch first
         db_batch = db.query(Batch).filter(Batch.batch_id == batch_id).first()
-        if db_batch:
-            # Find the verification by batch_id and index
-            db_verification = db.query(Verification).filter(
+        if not db_batch:
+            return
+
+        row_ids = dict(
+            db.query(Verification.batch_index, Verification.id).filter(
                 Verification.batch_id == db_batch.id,
-                Verification.batch_index == item_index
-            ).first()
-
-            if db_verification:
-                db_verification.status = status
-                if status == VerificationStatus.PROCESSING:
-                    db_verification.started_at = datetime.utcnow()
-                elif status in [VerificationStatus.COMPLETED, VerificationStatus.FAILED]:
-                    db_verification.completed_at = datetime.utcnow()
-
-                if result:
-                    db_verification.valid = result.get("valid", False)
-                    db_verification.sat_response = result
-                if error:
-                    db_verification.error_message = error
-
-                # Update batch counts
-                if status == VerificationStatus.COMPLETED:
-                    db_batch.completed_count += 1
-                elif status == VerificationStatus.FAILED:
-                    db_batch.failed_count += 1
-
-                # Check if batch is complete
-                if db_batch.completed_count + db_batch.failed_count >= db_batch.total_items:
-                    db_batch.status = VerificationStatus.COMPLETED
-                    db_batch.completed_at = datetime.utcnow()
-
-                db.commit()
-                logger.info(f"Updated verification for batch {batch_id}, item {item_index}: {status}")
+                Verification.batch_index >= offset,
+                Verification.batch_index < offset + len(results),
+            )
+        )
+
+        now = utcnow()
+        mappings = []
+        failed = 0
+        for index, result in enumerate(results, start=offset):
+            if index not in row_ids:
+                continue
+            if "error" in result:
+                failed += 1
+                mappings.append({
+                    "id": row_ids[index],
+                    "status": VerificationStatus.FAILED,
+                    "error_message": result["error"],
+                    "completed_at": now,
+                })
+            else:
+                mappings.append({
+                    "id": row_ids[index],
+                    "status": VerificationStatus.COMPLETED,
+                    "valid": result.get("valid", False),
+                    "sat_response": result,
+                    "completed_at": now,
+                })
+        db.bulk_update_mappings(Verification, mappings)
+
+        # Relative increments so concurrent chunks don't overwrite each other
+        db.execute(
+            update(Batch)
+            .where(Batch.id == db_batch.id)
+            .values(
+                completed_count=Batch.completed_count + (len(mappings) - failed),
+                failed_count=Batch.failed_count + failed,
+            )
+        )
+        db.execute(
+            update(Batch)
+            .where(
+                Batch.id == db_batch.id,
+                Batch.completed_count + Batch.failed_count >= Batch.total_items,
+                Batch.completed_at.is_(None),
+            )
+            .values(status=VerificationStatus.COMPLETED, completed_at=now)
+        )
+        db.commit()
+        logger.info(f"Saved {len(mappings)} results for batch {batch_id} at offset {offset}")
     except Exception as e:
-        logger.error(f"DB error updating verification: {e}")
+        logger.error(f"DB error saving chunk results: {e}")
         db.rollback()
     finally:
         db.close()
 
 
-def solve_captcha_sync(image_bytes: bytes) -> str:
-    """Solve CAPTCHA using 2Captcha service (sync version for Celery)."""
+# Solves CAPTCHAs off the browser loop, so form filling (and other verifications)
+# overlap the 2Captcha wait; sized for a threads pool of verifications
+captcha_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="captcha")
+
+CAPTCHA_JPEG_QUALITY = 85
+
+
+# ---------- SAT form ----------
+
+SAT_URL = "https://verificacfdi.facturaelectronica.sat.gob.mx/"
+
+# Verify folios by posting the SAT form with httpx, falling back to the browser
+SAT_DIRECT_POST = os.getenv("SAT_DIRECT_POST", "true").lower() in ("1", "true", "yes")
+
+SAT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+    "Accept-Language": "es-MX,es;q=0.9",
+}
+
+# Per-request cap for the direct SAT requests, within the verification's deadline
+SAT_REQUEST_TIMEOUT = 30
+
+CAPTCHA_IMG = "#ctl00_MainContent_ImgCaptcha"
+CAPTCHA_INPUT = "#ctl00_MainContent_TxtCaptchaNumbers"
+CAPTCHA_XML_IMG = "#ctl00_MainContent_ImgCaptchaXml"
+CAPTCHA_XML_INPUT = "#ctl00_MainContent_TxtCaptchaNumbersXml"
+UUID_INPUT = "#ctl00_MainContent_TxtUUID"
+RFC_EMISOR_INPUT = "#ctl00_MainContent_TxtRfcEmisor"
+RFC_RECEPTOR_INPUT = "#ctl00_MainContent_TxtRfcReceptor"
+# The folio and XML forms each have one; a CSS match is cheaper than a role
+# query, which walks the accessibility tree
+SUBMIT_BUTTON = 'input[type="submit"][value="Verificar CFDI"]:visible'
+
+CAPTCHA_READY_JS = """sel => {
+    const img = document.querySelector(sel);
+    return !!img && img.complete && img.naturalWidth > 0;
+}"""
+
+# Any of these in the visible text means SAT has answered the submission
+OUTCOME_JS = "() => !!document.body && /Vigente|Cancelado|incorrecto|válido/i.test(document.body.innerText)"
+
+
+# Sets several inputs in one round trip, firing the events fill() would
+FILL_JS = """fields => {
+    for (const [sel, value] of Object.entries(fields)) {
+        const input = document.querySelector(sel);
+        if (!input) throw new Error(`No input ${sel} on the page`);
+        input.value = value;
+        input.dispatchEvent(new Event("input", {bubbles: true}));
+        input.dispatchEvent(new Event("change", {bubbles: true}));
+    }
+}"""
+
+
+def is_sat_postback(response) -> bool:
+    return response.request.method == "POST" and "verificacfdi" in response.url
+
+
+def data_uri_bytes(src: str) -> bytes:
+    """Payload of a base64 data: URI."""
+    return base64.b64decode(src.partition(",")[2])
+
+
+async def wait_for_captcha(page, selector: str):
+    """Wait until the browser has finished loading the CAPTCHA image."""
+    await page.wait_for_function(CAPTCHA_READY_JS, arg=selector)
+
+
+async def capture_captcha(page, selector: str) -> bytes:
+    """
+    The CAPTCHA image as SAT encoded it, fetched with the page's cookies instead
+    of rasterizing the element. Falls back to a JPEG screenshot if the fetch fails.
+    """
+    # Let the browser's own load finish first: SAT keeps the code of the last image it served
+    await wait_for_captcha(page, selector)
+    src = await page.locator(selector).get_attribute("src")
+    if src and src.startswith("data:"):
+        return data_uri_bytes(src)
+    if src:
+        response = await page.request.get(urljoin(page.url, src))
+        if response.ok:
+            return await response.body()
+        logger.warning(f"CAPTCHA fetch returned {response.status}, using a screenshot")
+    return await page.locator(selector).screenshot(type="jpeg", quality=CAPTCHA_JPEG_QUALITY)
+
+
+async def fill_folio_form(page, folio_fiscal: str, rfc_emisor: str, rfc_receptor: str):
+    """Fill the folio and both RFCs with one evaluate instead of a locator fill each."""
+    await page.evaluate(FILL_JS, {
+        UUID_INPUT: folio_fiscal,
+        RFC_EMISOR_INPUT: rfc_emisor,
+        RFC_RECEPTOR_INPUT: rfc_receptor,
+    })
+
+
+async def submit_and_wait(page):
+    """Click 'Verificar CFDI' and wait for SAT's answer instead of sleeping."""
+    async with page.expect_response(is_sat_postback):
+        await page.locator(SUBMIT_BUTTON).click()
+    try:
+        await page.wait_for_function(OUTCOME_JS, timeout=2000)
+    except PlaywrightTimeoutError:
+        pass  # No known marker (e.g. CFDI not found), callers classify the page
+
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+WEBHOOK_SYNC_ATTEMPTS = 3
+
+# Webhooks are posted from these threads, so tasks return without waiting on the receiver
+webhook_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="webhook")
+
+
+def get_http_client() -> httpx.Client:
+    """
+    HTTP client shared by the tasks of this worker process (2Captcha and
+    webhooks), keeping connections alive. Created lazily so it's never
+    inherited across the prefork pool's fork.
+    """
+    global _http_client
+    if _http_client is not None:
+        return _http_client
+
+    # Task, CAPTCHA and webhook threads can all get here first
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = httpx.Client(
+                timeout=30,
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+            )
+        return _http_client
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def close_http_client(**extra):
+    """
+    Close the shared client's pooled connections when the worker process exits,
+    after the webhooks still queued have been sent.
+    """
+    global _http_client
+    webhook_executor.shutdown(wait=True)
+    with _http_client_lock:
+        if _http_client is not None:
+            _http_client.close()
+            _http_client = None
+
+
+TWOCAPTCHA_URL = "https://2captcha.com"
+TWOCAPTCHA_POLL_INTERVAL = float(os.getenv("TWOCAPTCHA_POLL_INTERVAL", "5"))
+TWOCAPTCHA_TIMEOUT = 120
+
+
+def twocaptcha_request_sync(path: str, fields: dict, post: bool = False, files: dict = None) -> str:
+    """Call the 2Captcha HTTP API (json=1 mode) and return its 'request' field."""
     api_key = os.getenv("TWOCAPTCHA_API_KEY")
     if not api_key:
         raise ValueError("TWOCAPTCHA_API_KEY not set")
 
-    solver = TwoCaptcha(api_key)
-    base64_image = base64.standard_b64encode(image_bytes).decode("utf-8")
-    result = solver.normal(base64_image)
-    return result["code"]
-
-
-def extract_results_sync(page) -> dict:
-    """Extract verification results from SAT page (sync version)."""
-    results = {
-        "valid": False,
-        "message": "",
-        "folio_fiscal": "",
-        "rfc_emisor": "",
-        "nombre_emisor": "",
-        "rfc_receptor": "",
-        "nombre_receptor": "",
-        "fecha_expedicion": "",
-        "fecha_certificacion": "",
-        "pac_certificador": "",
-        "total": "",
-        "efecto": "",
-        "estado": "",
-        "estatus_cancelacion": "",
-        "fecha_cancelacion": "",
-    }
+    fields = {"key": api_key, "json": 1, **fields}
+    if post:
+        response = get_http_client().post(f"{TWOCAPTCHA_URL}/{path}", data=fields, files=files)
+    else:
+        response = get_http_client().get(f"{TWOCAPTCHA_URL}/{path}", params=fields)
+    response.raise_for_status()
+    data = response.json()
+    if data["status"] != 1 and data["request"] != "CAPCHA_NOT_READY":
+        raise ValueError(f"2Captcha error: {data['request']}")
+    return data["request"]
+
+
+def solve_with_2captcha_sync(image_bytes: bytes, timeout: float = TWOCAPTCHA_TIMEOUT) -> str:
+    """Submit the CAPTCHA to 2Captcha and poll for the answer over the shared client."""
+    # Uploaded as a multipart file, a third smaller than the base64 form
+    captcha_id = twocaptcha_request_sync(
+        "in.php", {"method": "post"}, post=True, files={"file": ("captcha", image_bytes)}
+    )
 
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(min(TWOCAPTCHA_POLL_INTERVAL, max(0, deadline - time.monotonic())))
+        answer = twocaptcha_request_sync("res.php", {"action": "get", "id": captcha_id})
+        if answer != "CAPCHA_NOT_READY":
+            return answer
+
+    raise TimeoutError(f"2Captcha did not solve CAPTCHA {captcha_id} within {timeout:.0f}s")
+
+
+def solve_captcha_sync(image_bytes: bytes, timeout: float = TWOCAPTCHA_TIMEOUT) -> str:
+    """
+    Solve CAPTCHA with the local model, falling back to 2Captcha (sync version for Celery).
+    Raises TimeoutError if 2Captcha has no answer within timeout seconds.
+    """
+    code = captcha_model.predict(image_bytes)
+    if code is not None:
+        return code
+    return solve_with_2captcha_sync(captcha_model.preprocess(image_bytes), timeout)
+
+
+# Visible text (a fraction of the size of page.content()) and the text of
+# every table cell, in a single round-trip
+READ_PAGE_JS = """() => ({
+    text: document.body ? document.body.innerText : '',
+    rows: Array.from(document.querySelectorAll('table tr')).map(
+        r => Array.from(r.querySelectorAll('td')).map(c => c.innerText.trim())
+    ),
+})"""
+
+
+async def read_page(page) -> dict:
+    """Outcome flags and table cell texts of the page SAT answered with."""
+    page_data = await page.evaluate(READ_PAGE_JS)
+    return {**sat_form.status_flags(page_data["text"]), "rows": page_data["rows"]}
+
+
+# ---------- Worker browser ----------
+
+# One Chromium per worker process (browser_manager's), driven by an event loop
+# thread of its own. Task threads hand it their verifications, so under
+# --pool=threads many verifications share one browser; under prefork each
+# child process still gets its own.
+_browser_loop = None
+_browser_loop_lock = threading.Lock()
+
+# Chromium's memory creeps up over a long-lived worker; a fresh browser is
+# launched after this many verifications and the old one closed once idle
+BROWSER_MAX_USES = int(os.getenv("BROWSER_MAX_USES", "50"))
+_browser_uses = 0
+_open_pages: dict = {}  # Browser -> verifications running on it
+_retired_browsers = set()
+
+
+def get_browser_loop() -> asyncio.AbstractEventLoop:
+    """This process's browser loop, started on first use (never inherited across fork)."""
+    global _browser_loop
+    with _browser_loop_lock:
+        if _browser_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="cfdi-browser", daemon=True).start()
+            _browser_loop = loop
+    return _browser_loop
+
+
+def run_in_browser(coro, timeout: float = None):
+    """Run a coroutine on the browser loop and wait for its result."""
+    future = asyncio.run_coroutine_threadsafe(coro, get_browser_loop())
     try:
-        page_content = page.content()
-
-        if "Vigente" in page_content:
-            results["valid"] = True
-            results["message"] = "CFDI vigente - válido y activo"
-        elif "Cancelado" in page_content:
-            results["valid"] = True
-            results["message"] = "CFDI cancelado"
-        else:
-            results["message"] = "CFDI no encontrado o inválido"
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        # Not the builtin TimeoutError before Python 3.11
+        future.cancel()
+        raise TimeoutError(f"Verification timed out after {timeout}s")
+    except BaseException:
+        # Anything interrupting the wait stops the verification too
+        future.cancel()
+        raise
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def close_worker_browser(**extra):
+    """Close the browser when a pool process (or a threads/solo worker) exits."""
+    global _browser_loop
+    loop = _browser_loop
+    if loop is None:
+        return
+    try:
+        run_in_browser(close_worker_browsers(), timeout=10)
+    except Exception as e:
+        logger.warning(f"Could not close worker browser: {e}")
+    loop.call_soon_threadsafe(loop.stop)
+    _browser_loop = None
+
+
+async def close_worker_browsers():
+    """Close the current and any retired browser of this process."""
+    for browser in list(_retired_browsers):
+        await browser.close()
+    _retired_browsers.clear()
+    _open_pages.clear()
+    await close_browser()
+
+
+@asynccontextmanager
+async def sat_page():
+    """
+    Page in a fresh context of the worker's browser (no cookies or SAT session
+    shared between verifications), skipping images, fonts and styles other
+    than the CAPTCHA. The context is closed on exit, and with it a retired
+    browser that has nothing else open.
+    """
+    global _browser_uses
+    browser = await get_browser()
+    _browser_uses += 1
+    if _browser_uses >= BROWSER_MAX_USES:
+        _browser_uses = 0
+        _retired_browsers.add(browser)
+        retire_browser(browser)
+
+    _open_pages[browser] = _open_pages.get(browser, 0) + 1
+    try:
+        context = await browser.new_context()
+        try:
+            if BLOCK_ASSETS:
+                await context.route("**/*", block_assets)
+            yield await context.new_page()
+        finally:
+            await context.close()
+    finally:
+        _open_pages[browser] -= 1
+        if not _open_pages[browser]:
+            del _open_pages[browser]
+            if browser in _retired_browsers:
+                _retired_browsers.discard(browser)
+                await browser.close()
+
+
+async def _verify_on_sat_page(verify, *args):
+    async with sat_page() as page:
+        return await verify(page, *args)
+
+
+def verify_on_sat_page(verify, *args, timeout: float = VERIFY_TIMEOUT):
+    """Run verify(page, *args) on a fresh page of the worker's browser and return its result."""
+    return run_in_browser(_verify_on_sat_page(verify, *args), timeout=timeout)
+
 
-        all_rows = page.locator("table tr")
-        row_count = all_rows.count()
+def time_left(deadline: float) -> float:
+    """Seconds until deadline (a time.monotonic() value); TimeoutError once it has passed."""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("Verification ran out of time")
+    return remaining
 
-        for i in range(row_count):
-            row = all_rows.nth(i)
-            cells = row.locator("td")
-            cell_count = cells.count()
 
-            if cell_count == 0:
+async def verify_folio_on_page(page, folio_fiscal: str, rfc_emisor: str, rfc_receptor: str,
+                               max_captcha_retries: int = 3):
+    """
+    Run the folio form on an open page.
+    Returns the results, or None if every CAPTCHA attempt was rejected.
+    Raises the last error if the final attempt fails.
+    """
+    on_form = False
+    for attempt in range(max_captcha_retries):
+        try:
+            logger.info(f"Attempt {attempt + 1}/{max_captcha_retries}")
+            if not on_form:
+                await page.goto(SAT_URL, wait_until="domcontentloaded")
+            on_form = False
+
+            # Start solving the CAPTCHA in the background, then fill the form meanwhile
+            captcha_bytes = await capture_captcha(page, CAPTCHA_IMG)
+            captcha_future = asyncio.get_running_loop().run_in_executor(
+                captcha_executor, solve_captcha_sync, captcha_bytes
+            )
+
+            try:
+                await fill_folio_form(page, folio_fiscal, rfc_emisor, rfc_receptor)
+            except BaseException:
+                captcha_future.cancel()
+                raise
+
+            captcha_text = await captcha_future
+            logger.info(f"CAPTCHA solution: {captcha_text}")
+
+            await page.locator(CAPTCHA_INPUT).fill(captcha_text)
+            await submit_and_wait(page)
+
+            page_data = await read_page(page)
+
+            found = page_data["vigente"] or page_data["cancelado"]
+            if not found and page_data["incorrecto"]:
+                logger.warning("CAPTCHA incorrect, retrying...")
+                # SAT answers with the form and a new CAPTCHA; retry in place, no reload
+                on_form = True
                 continue
 
-            cell_texts = []
-            for j in range(cell_count):
-                text = cells.nth(j).inner_text().strip()
-                cell_texts.append(text)
-
-            if cell_count >= 4:
-                if cell_texts[0] and len(cell_texts[0]) >= 12 and len(cell_texts[0]) <= 13:
-                    if not cell_texts[0].startswith("RFC") and not results["rfc_emisor"]:
-                        results["rfc_emisor"] = cell_texts[0]
-                        results["nombre_emisor"] = cell_texts[1]
-                        results["rfc_receptor"] = cell_texts[2]
-                        results["nombre_receptor"] = cell_texts[3]
-
-                if "-" in cell_texts[0] and "T" in cell_texts[1]:
-                    results["folio_fiscal"] = cell_texts[0]
-                    results["fecha_expedicion"] = cell_texts[1]
-                    results["fecha_certificacion"] = cell_texts[2] if cell_count > 2 else ""
-                    results["pac_certificador"] = cell_texts[3] if cell_count > 3 else ""
-
-            if cell_count >= 3:
-                if cell_texts[0].startswith("$"):
-                    results["total"] = cell_texts[0]
-                    results["efecto"] = cell_texts[1]
-                    results["estado"] = cell_texts[2]
-
-            if cell_count >= 2:
-                if "Cancelado" in cell_texts[0] and "T" in cell_texts[1]:
-                    results["estatus_cancelacion"] = cell_texts[0]
-                    results["fecha_cancelacion"] = cell_texts[1]
+            return sat_form.results_from_page(page_data)
 
-    except Exception as e:
-        logger.error(f"Error extracting results: {e}")
+        except Exception as e:
+            logger.error(f"Error on attempt {attempt + 1}: {e}")
+            if attempt < max_captcha_retries - 1:
+                continue
+            raise
 
-    return results
+    return None
+
+
+def verify_folio_http(folio_fiscal: str, rfc_emisor: str, rfc_receptor: str,
+                      max_captcha_retries: int = 3, deadline: float = None):
+    """
+    Submit the SAT form with httpx: GET for the form state and CAPTCHA, then POST.
+    A rejected CAPTCHA is retried on the form SAT answers with, without another GET.
+    Returns the results, or None if every CAPTCHA attempt was rejected.
+    Raises sat_form.SatFormError or httpx.HTTPError when SAT doesn't respond as expected,
+    TimeoutError once the deadline (default: VERIFY_TIMEOUT from now) has passed.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + VERIFY_TIMEOUT
+
+    def request_timeout() -> float:
+        # Checked before every request, so each step fits in what's left
+        return min(SAT_REQUEST_TIMEOUT, time_left(deadline))
+
+    # Own client per verification: the CAPTCHA is bound to the session cookie
+    with httpx.Client(follow_redirects=True, headers=SAT_HEADERS) as client:
+        form_state = None  # Fields, CAPTCHA URL and action of a form SAT already served
+        for attempt in range(max_captcha_retries):
+            logger.info(f"Direct attempt {attempt + 1}/{max_captcha_retries}")
+            if form_state is None:
+                form = client.get(SAT_URL, timeout=request_timeout())
+                form.raise_for_status()
+                form_state = (*sat_form.parse_form(form.text, str(form.url)), str(form.url))
+            fields, captcha_url, form_url = form_state
+            form_state = None
+
+            captcha = client.get(captcha_url, timeout=request_timeout())
+            captcha.raise_for_status()
+            # The 2Captcha wait is the longest step; it only gets what's left too
+            captcha_text = solve_captcha_sync(captcha.content, timeout=time_left(deadline))
+            logger.info(f"CAPTCHA solution: {captcha_text}")
+
+            response = client.post(
+                form_url,
+                data=sat_form.folio_form_data(fields, folio_fiscal, rfc_emisor, rfc_receptor, captcha_text),
+                timeout=request_timeout(),
+            )
+            response.raise_for_status()
+            page_data = sat_form.parse_result(response.text)
+
+            if page_data["incorrecto"] and not (page_data["vigente"] or page_data["cancelado"]):
+                logger.warning("CAPTCHA incorrect, retrying...")
+                # SAT answers with the form and a new CAPTCHA; retry on it without a new GET
+                try:
+                    form_state = (*sat_form.parse_form(response.text, str(response.url)), str(response.url))
+                except sat_form.SatFormError:
+                    pass
+                continue
+            return sat_form.results_from_page(page_data)
+
+    return None
+
+
+def verify_folio(folio_fiscal: str, rfc_emisor: str, rfc_receptor: str, max_captcha_retries: int = 3,
+                 deadline: float = None):
+    """
+    Verify a folio over plain HTTP, or on the worker's browser if SAT's page
+    isn't the form we know. Returns None if every CAPTCHA attempt was rejected.
+    Both paths together stop at deadline (default: VERIFY_TIMEOUT from now),
+    then TimeoutError is raised.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + VERIFY_TIMEOUT
+    if SAT_DIRECT_POST:
+        try:
+            return verify_folio_http(folio_fiscal, rfc_emisor, rfc_receptor, max_captcha_retries, deadline)
+        except (sat_form.SatFormError, httpx.HTTPError) as e:
+            logger.warning(f"Direct SAT request failed, using the browser: {e}")
+
+    return verify_on_sat_page(
+        verify_folio_on_page, folio_fiscal, rfc_emisor, rfc_receptor, max_captcha_retries,
+        timeout=time_left(deadline),
+    )
 
 
 @celery_app.task(bind=True, max_retries=3)
 def verify_folio_task(self, folio_fiscal: str, rfc_emisor: str, rfc_receptor: str,
-                       webhook_url: str = None, batch_id: str = None, item_index: int = None):
+                       webhook_url: str = None, batch_id: str = None, item_index: int = None,
+                       max_captcha_retries: int = 3, send_per_item: bool = True):
     """
-    Celery task to verify CFDI by Folio Fiscal.
-    Uses sync Playwright since Celery workers run in separate processes.
+    Celery task to verify CFDI by Folio Fiscal, over HTTP or on the worker process's shared browser.
+    Batches pass send_per_item=False and rely on batch_complete_callback's webhook.
     """
     logger.info(f"Starting verification for folio: {folio_fiscal}")
 
@@ -172,94 +665,245 @@ def verify_folio_task(self, folio_fiscal: str, rfc_emisor: str, rfc_receptor: st
     if batch_id is not None and item_index is not None:
         update_verification_status(batch_id, item_index, VerificationStatus.PROCESSING)
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
+    try:
+        results = verify_folio(folio_fiscal, rfc_emisor, rfc_receptor, max_captcha_retries)
+    except Exception as e:
+        # Update DB with failure
+        if batch_id is not None and item_index is not None:
+            update_verification_status(batch_id, item_index, VerificationStatus.FAILED, error=str(e))
 
-        max_captcha_retries = 3
-        for attempt in range(max_captcha_retries):
-            try:
-                logger.info(f"Attempt {attempt + 1}/{max_captcha_retries}")
-                page.goto("https://verificacfdi.facturaelectronica.sat.gob.mx/")
-                page.wait_for_load_state("networkidle")
-                page.wait_for_timeout(500)
-
-                # Fill form
-                page.locator("#ctl00_MainContent_TxtUUID").fill(folio_fiscal)
-                page.locator("#ctl00_MainContent_TxtRfcEmisor").fill(rfc_emisor)
-                page.locator("#ctl00_MainContent_TxtRfcReceptor").fill(rfc_receptor)
-
-                # Solve CAPTCHA
-                captcha_img = page.locator("#ctl00_MainContent_ImgCaptcha")
-                captcha_bytes = captcha_img.screenshot()
-                captcha_text = solve_captcha_sync(captcha_bytes)
-                logger.info(f"CAPTCHA solution: {captcha_text}")
-
-                page.locator("#ctl00_MainContent_TxtCaptchaNumbers").fill(captcha_text)
-                page.get_by_role("button", name="Verificar CFDI").click()
-                page.wait_for_timeout(2000)
-
-                page_content = page.content()
-
-                if "Vigente" in page_content or "Cancelado" in page_content:
-                    results = extract_results_sync(page)
-                    browser.close()
-
-                    # Update DB with success
-                    if batch_id is not None and item_index is not None:
-                        update_verification_status(batch_id, item_index, VerificationStatus.COMPLETED, result=results)
-
-                    # Send webhook if configured
-                    if webhook_url:
-                        send_webhook_sync(webhook_url, {
-                            "type": "item_completed" if batch_id else "completed",
-                            "batch_id": batch_id,
-                            "item_index": item_index,
-                            "folio_fiscal": folio_fiscal,
-                            "result": results
-                        })
-
-                    return results
-
-                elif "incorrecto" in page_content.lower():
-                    logger.warning("CAPTCHA incorrect, retrying...")
-                    if attempt < max_captcha_retries - 1:
-                        page.reload()
-                        continue
-                else:
-                    results = extract_results_sync(page)
-                    browser.close()
-
-                    # Update DB with results
-                    if batch_id is not None and item_index is not None:
-                        update_verification_status(batch_id, item_index, VerificationStatus.COMPLETED, result=results)
-
-                    return results
-
-            except Exception as e:
-                logger.error(f"Error on attempt {attempt + 1}: {e}")
-                if attempt < max_captcha_retries - 1:
-                    page.reload()
-                    continue
-
-                # Update DB with failure
-                if batch_id is not None and item_index is not None:
-                    update_verification_status(batch_id, item_index, VerificationStatus.FAILED, error=str(e))
-
-                browser.close()
-                raise self.retry(exc=e, countdown=5)
+        raise self.retry(exc=e, countdown=5)
 
+    if results is None:
         # Update DB with failure after all retries
         if batch_id is not None and item_index is not None:
             update_verification_status(batch_id, item_index, VerificationStatus.FAILED, error="Failed after max CAPTCHA attempts")
 
-        browser.close()
         raise Exception(f"Failed after {max_captcha_retries} CAPTCHA attempts")
 
+    # Update DB with success
+    if batch_id is not None and item_index is not None:
+        update_verification_status(batch_id, item_index, VerificationStatus.COMPLETED, result=results)
+
+    # Send webhook if configured
+    if webhook_url and send_per_item and results["valid"]:
+        send_webhook_sync(webhook_url, {
+            "type": "item_completed" if batch_id else "completed",
+            "batch_id": batch_id,
+            "item_index": item_index,
+            "folio_fiscal": folio_fiscal,
+            "result": results
+        })
+
+    return results
+
+
+# Items each chunk task verifies at the same time; each one mostly waits on SAT
+# or 2Captcha, so a chunk's items overlap instead of queueing. A worker process
+# runs up to worker_concurrency chunks (10), so up to 40 items at once by default.
+BATCH_ITEM_CONCURRENCY = int(os.getenv("BATCH_ITEM_CONCURRENCY", "4"))
+
+
+def verify_batch_item(item: dict, max_captcha_retries: int, chunk_deadline: float) -> dict:
+    """Result of one batch item, or {"error": ...} if it couldn't be verified."""
+    # Its own VERIFY_TIMEOUT from when it starts, but never past the chunk's deadline
+    deadline = min(chunk_deadline, time.monotonic() + VERIFY_TIMEOUT)
+    try:
+        result = verify_folio(item["id"], item["re"], item["rr"], max_captcha_retries, deadline)
+    except Exception as e:
+        return {"error": str(e)}
+    if result is None:
+        return {"error": f"Failed after {max_captcha_retries} CAPTCHA attempts"}
+    return result
+
+
+@celery_app.task(bind=True)
+def verify_folio_chunk_task(self, items: list, batch_id: str, offset: int,
+                            webhook_url: str = None, max_captcha_retries: int = 3,
+                            send_per_item: bool = False):
+    """
+    Verify a slice of a batch, up to BATCH_ITEM_CONCURRENCY items at a time,
+    each over HTTP or in its own browser context.
+
+    items are {"id", "re", "rr"} dicts at batch indexes offset.. offset+len(items)-1.
+    Failed items get {"error": ...} in place of their result, so one bad folio
+    doesn't fail the chunk. DB rows are written in a single commit at the end.
+    """
+    logger.info(f"Starting chunk of {len(items)} items for batch {batch_id} at offset {offset}")
+    mark_chunk_processing(batch_id, offset, len(items))
+
+    # The threads pool doesn't enforce Celery time limits, so the chunk keeps its own
+    # deadline. Its own executor, so its items never queue behind other chunks' items.
+    deadline = time.monotonic() + BATCH_CHUNK_TIMEOUT
+    executor = ThreadPoolExecutor(max_workers=BATCH_ITEM_CONCURRENCY, thread_name_prefix="batch-item")
+    futures = [
+        executor.submit(verify_batch_item, item, max_captcha_retries, deadline)
+        for item in items
+    ]
+    results = []
+    try:
+        for item, future in zip(items, futures):
+            concurrent.futures.wait([future], timeout=max(0, deadline - time.monotonic()))
+            if future.done():
+                result = future.result()
+            else:
+                # Running items stop at their next deadline check
+                logger.error(f"Item {offset + len(results)} of batch {batch_id} timed out in its chunk")
+                result = {"error": "Chunk time limit exceeded"}
+            results.append(result)
+
+            if webhook_url and send_per_item:
+                send_webhook_sync(webhook_url, {
+                    "type": "item_completed",
+                    "batch_id": batch_id,
+                    "item_index": offset + len(results) - 1,
+                    "folio_fiscal": item["id"],
+                    "result": result
+                })
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    save_chunk_results(batch_id, offset, results)
+    return results
+
+
+# ---------- Batch counters ----------
+
+redis_client = redis.Redis.from_url(REDIS_URL)
+
+
+def batch_counters_key(batch_id: str) -> str:
+    return f"cfdi:batch:{batch_id}:counters"
+
+
+@task_postrun.connect
+def count_chunk_results(task=None, kwargs=None, retval=None, state=None, **extra):
+    """
+    Add a finished chunk's outcome to its batch's completed/failed counters,
+    so status requests read one hash instead of every chunk result.
+    A chunk that failed as a whole counts all of its items as failed.
+    """
+    if task.name != verify_folio_chunk_task.name:
+        return
+
+    if state == states.SUCCESS:
+        failed = sum(1 for r in retval if "error" in r)
+        completed = len(retval) - failed
+    elif state == states.FAILURE:
+        completed, failed = 0, len(kwargs["items"])
+    else:
+        return
+
+    key = batch_counters_key(kwargs["batch_id"])
+    try:
+        with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hincrby(key, "completed", completed)
+            pipe.hincrby(key, "failed", failed)
+            pipe.expire(key, celery_app.conf.result_expires)
+            pipe.execute()
+    except Exception as e:
+        logger.error(f"Failed to update counters for batch {kwargs['batch_id']}: {e}")
+
+
+# ---------- Worker heartbeat ----------
+
+# Each worker publishes its task counts for /queue/stats; a stopped worker's
+# entry expires on its own
+WORKER_HEARTBEAT_INTERVAL = 5
+WORKER_HEARTBEAT_TTL = 15
+
+_heartbeat_stop = threading.Event()
+
+
+def worker_heartbeat_key(hostname: str) -> str:
+    return f"cfdi:worker:{hostname}"
+
+
+def publish_worker_heartbeat(hostname: str):
+    """Write this worker's active/reserved task counts every WORKER_HEARTBEAT_INTERVAL seconds."""
+    key = worker_heartbeat_key(hostname)
+    while True:
+        # reserved_requests includes the ones being executed
+        active = len(worker_state.active_requests)
+        reserved = len(worker_state.reserved_requests) - active
+        try:
+            with redis_client.pipeline(transaction=True) as pipe:
+                pipe.hset(key, mapping={"active": active, "reserved": max(reserved, 0), "updated": time.time()})
+                pipe.expire(key, WORKER_HEARTBEAT_TTL)
+                pipe.execute()
+        except Exception as e:
+            logger.warning(f"Worker heartbeat failed: {e}")
+        if _heartbeat_stop.wait(WORKER_HEARTBEAT_INTERVAL):
+            return
+
+
+@worker_ready.connect
+def start_worker_heartbeat(sender=None, **extra):
+    threading.Thread(
+        target=publish_worker_heartbeat, args=(sender.hostname,), name="cfdi-heartbeat", daemon=True
+    ).start()
+
+
+@worker_shutdown.connect
+def stop_worker_heartbeat(sender=None, **extra):
+    _heartbeat_stop.set()
+    try:
+        redis_client.delete(worker_heartbeat_key(sender.hostname))
+    except Exception as e:
+        logger.warning(f"Could not remove worker heartbeat: {e}")
+
+
+async def verify_xml_on_page(page, xml_content: str, max_captcha_retries: int = 3):
+    """
+    Run the XML upload form on an open page.
+    Returns the results, or None if every CAPTCHA attempt was rejected.
+    Raises the last error if the final attempt fails.
+    """
+    # Handed to the file chooser from memory, no temp file
+    xml_file = {"name": "cfdi.xml", "mimeType": "application/xml", "buffer": xml_content.encode("utf-8")}
+
+    for attempt in range(max_captcha_retries):
+        try:
+            await page.goto(SAT_URL, wait_until="domcontentloaded")
+
+            await page.get_by_role("radio", name="Consulta por archivo XML").click()
+            await wait_for_captcha(page, CAPTCHA_XML_IMG)
+
+            async with page.expect_file_chooser() as fc_info:
+                await page.get_by_text("Buscar").click()
+            file_chooser = await fc_info.value
+            await file_chooser.set_files(xml_file)
+
+            captcha_bytes = await capture_captcha(page, CAPTCHA_XML_IMG)
+            captcha_text = await asyncio.get_running_loop().run_in_executor(
+                captcha_executor, solve_captcha_sync, captcha_bytes
+            )
+
+            await page.locator(CAPTCHA_XML_INPUT).fill(captcha_text)
+            await submit_and_wait(page)
+
+            page_data = await read_page(page)
+
+            found = page_data["vigente"] or page_data["cancelado"]
+            if not found and page_data["incorrecto"]:
+                logger.warning("CAPTCHA incorrect, retrying...")
+                continue
+
+            return sat_form.results_from_page(page_data)
+
+        except Exception as e:
+            logger.error(f"Error on attempt {attempt + 1}: {e}")
+            if attempt < max_captcha_retries - 1:
+                continue
+            raise
+
+    return None
+
 
 @celery_app.task(bind=True, max_retries=3)
 def verify_xml_task(self, xml_content: str, webhook_url: str = None,
-                    batch_id: str = None, item_index: int = None):
+                    batch_id: str = None, item_index: int = None, max_captcha_retries: int = 3,
+                    send_per_item: bool = True):
     """Celery task to verify CFDI by XML content."""
     logger.info("Starting XML verification")
 
@@ -267,113 +911,132 @@ def verify_xml_task(self, xml_content: str, webhook_url: str = None,
     if batch_id is not None and item_index is not None:
         update_verification_status(batch_id, item_index, VerificationStatus.PROCESSING)
 
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".xml", delete=False) as f:
-        f.write(xml_content)
-        xml_path = f.name
-
     try:
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=True)
-            page = browser.new_page()
-
-            max_captcha_retries = 3
-            for attempt in range(max_captcha_retries):
-                try:
-                    page.goto("https://verificacfdi.facturaelectronica.sat.gob.mx/")
-                    page.wait_for_load_state("networkidle")
-
-                    page.get_by_role("radio", name="Consulta por archivo XML").click()
-                    page.wait_for_timeout(500)
-
-                    with page.expect_file_chooser() as fc_info:
-                        page.get_by_text("Buscar").click()
-                    file_chooser = fc_info.value
-                    file_chooser.set_files(xml_path)
-                    page.wait_for_timeout(500)
-
-                    captcha_img = page.locator("#ctl00_MainContent_ImgCaptchaXml")
-                    captcha_bytes = captcha_img.screenshot()
-                    captcha_text = solve_captcha_sync(captcha_bytes)
+        results = verify_on_sat_page(verify_xml_on_page, xml_content, max_captcha_retries)
+    except Exception as e:
+        # Update DB with failure
+        if batch_id is not None and item_index is not None:
+            update_verification_status(batch_id, item_index, VerificationStatus.FAILED, error=str(e))
 
-                    page.locator("#ctl00_MainContent_TxtCaptchaNumbersXml").fill(captcha_text)
-                    page.get_by_role("button", name="Verificar CFDI").click()
-                    page.wait_for_timeout(2000)
+        raise self.retry(exc=e, countdown=5)
 
-                    page_content = page.content()
+    if results is None:
+        # Update DB with failure after all retries
+        if batch_id is not None and item_index is not None:
+            update_verification_status(batch_id, item_index, VerificationStatus.FAILED, error="Failed after max CAPTCHA attempts")
 
-                    if "Vigente" in page_content or "Cancelado" in page_content:
-                        results = extract_results_sync(page)
-                        browser.close()
+        raise Exception(f"Failed after {max_captcha_retries} attempts")
 
-                        # Update DB with success
-                        if batch_id is not None and item_index is not None:
-                            update_verification_status(batch_id, item_index, VerificationStatus.COMPLETED, result=results)
+    # Update DB with results
+    if batch_id is not None and item_index is not None:
+        update_verification_status(batch_id, item_index, VerificationStatus.COMPLETED, result=results)
 
-                        if webhook_url:
-                            send_webhook_sync(webhook_url, {
-                                "type": "item_completed" if batch_id else "completed",
-                                "batch_id": batch_id,
-                                "item_index": item_index,
-                                "result": results
-                            })
+    if webhook_url and send_per_item and results["valid"]:
+        send_webhook_sync(webhook_url, {
+            "type": "item_completed" if batch_id else "completed",
+            "batch_id": batch_id,
+            "item_index": item_index,
+            "result": results
+        })
 
-                        return results
+    return results
 
-                    elif "incorrecto" in page_content.lower():
-                        if attempt < max_captcha_retries - 1:
-                            page.reload()
-                            continue
-                    else:
-                        results = extract_results_sync(page)
-                        browser.close()
 
-                        # Update DB with results
-                        if batch_id is not None and item_index is not None:
-                            update_verification_status(batch_id, item_index, VerificationStatus.COMPLETED, result=results)
+# ---------- Async API jobs ----------
 
-                        return results
+def save_job_verification(job_id: str, **values):
+    """Update the DB row of an async API job."""
+    db = SessionLocal()
+    try:
+        db.execute(update(Verification).where(Verification.job_id == job_id).values(**values))
+        db.commit()
+    except Exception as e:
+        logger.error(f"DB error saving job {job_id}: {e}")
+        db.rollback()
+    finally:
+        db.close()
 
-                except Exception as e:
-                    logger.error(f"Error on attempt {attempt + 1}: {e}")
-                    if attempt < max_captcha_retries - 1:
-                        page.reload()
-                        continue
 
-                    # Update DB with failure
-                    if batch_id is not None and item_index is not None:
-                        update_verification_status(batch_id, item_index, VerificationStatus.FAILED, error=str(e))
+def finish_job(job_id: str, created_at: str, webhook_url: str, values: dict,
+               result: dict = None, error: str = None):
+    """Save a job's outcome and send its webhook, in the same format as the API's."""
+    if webhook_url:
+        send_webhook_sync(webhook_url, {
+            "job_id": job_id,
+            "status": values["status"].value,
+            "created_at": created_at,
+            "completed_at": values["completed_at"].isoformat(),
+            "result": result,
+            "error": error,
+        }, on_delivered=lambda: save_job_verification(job_id, webhook_sent=True))
+    save_job_verification(job_id, **values)
+
+
+@celery_app.task(ignore_result=True)
+def job_completed_callback(result: dict, job_id: str, created_at: str,
+                           webhook_url: str = None, from_xml: bool = False):
+    """Linked to an async job's verification task; stores the result and notifies."""
+    values = {
+        "status": VerificationStatus.COMPLETED,
+        "valid": result.get("valid", False),
+        "sat_response": result,
+        "completed_at": utcnow(),
+    }
+    if from_xml:
+        # Only known once the XML has been read by SAT
+        values["folio_fiscal"] = result.get("folio_fiscal")
+        values["rfc_emisor"] = result.get("rfc_emisor")
+        values["rfc_receptor"] = result.get("rfc_receptor")
+    finish_job(job_id, created_at, webhook_url, values, result=result)
+
+
+@celery_app.task(ignore_result=True)
+def job_failed_callback(request, exc, traceback, job_id: str, created_at: str,
+                        webhook_url: str = None, from_xml: bool = False):
+    """Error callback of an async job's verification task, once its retries are exhausted."""
+    values = {
+        "status": VerificationStatus.FAILED,
+        "error_message": str(exc),
+        "completed_at": utcnow(),
+    }
+    finish_job(job_id, created_at, webhook_url, values, error=str(exc))
 
-                    browser.close()
-                    raise self.retry(exc=e, countdown=5)
 
-            # Update DB with failure after all retries
-            if batch_id is not None and item_index is not None:
-                update_verification_status(batch_id, item_index, VerificationStatus.FAILED, error="Failed after max CAPTCHA attempts")
+def batch_item_count(status: VerificationStatus):
+    """Correlated subquery counting a batch's verifications in the given status."""
+    return select(func.count(Verification.id)).where(
+        Verification.batch_id == Batch.id,
+        Verification.status == status,
+    ).scalar_subquery()
 
-            browser.close()
-            raise Exception(f"Failed after {max_captcha_retries} attempts")
 
+def mark_batch_webhook_sent(batch_id: str):
+    db = SessionLocal()
+    try:
+        db.execute(update(Batch).where(Batch.batch_id == batch_id).values(webhook_sent=True))
+        db.commit()
     finally:
-        Path(xml_path).unlink(missing_ok=True)
+        db.close()
 
 
 @celery_app.task
 def batch_complete_callback(results: list, batch_id: str, webhook_url: str = None):
     """Called when all items in a batch are complete."""
+    # Chunk tasks return a list of item results each
+    results = [r for chunk in results for r in (chunk if isinstance(chunk, list) else [chunk])]
     logger.info(f"Batch {batch_id} complete with {len(results)} results")
 
-    # Update batch webhook_sent status in DB
+    # Settle the batch row in one UPDATE, recounting from its verifications
     db = SessionLocal()
     try:
-        db_batch = db.query(Batch).filter(Batch.batch_id == batch_id).first()
-        if db_batch:
-            db_batch.status = VerificationStatus.COMPLETED
-            db_batch.completed_at = datetime.utcnow()
-
-            if webhook_url:
-                db_batch.webhook_sent = True
-
-            db.commit()
+        values = {
+            "status": VerificationStatus.COMPLETED,
+            "completed_at": utcnow(),
+            "completed_count": batch_item_count(VerificationStatus.COMPLETED),
+            "failed_count": batch_item_count(VerificationStatus.FAILED),
+        }
+        db.execute(update(Batch).where(Batch.batch_id == batch_id).values(**values))
+        db.commit()
     except Exception as e:
         logger.error(f"DB error updating batch: {e}")
     finally:
@@ -390,17 +1053,66 @@ def batch_complete_callback(results: list, batch_id: str, webhook_url: str = Non
             "completed": completed,
             "failed": failed,
             "results": results
-        })
+        }, on_delivered=lambda: mark_batch_webhook_sent(batch_id))
 
     return {"batch_id": batch_id, "total": len(results), "results": results}
 
 
-def send_webhook_sync(webhook_url: str, payload: dict):
-    """Send webhook notification (sync version)."""
-    try:
-        import requests
-        response = requests.post(webhook_url, json=payload, timeout=30)
-        response.raise_for_status()
-        logger.info(f"Webhook sent successfully to {webhook_url}")
-    except Exception as e:
-        logger.error(f"Webhook failed: {e}")
+@celery_app.task(ignore_result=True)
+def refresh_stats_task():
+    """Recompute the /stats materialized views (scheduled by Celery beat)."""
+    refresh_stats_views()
+
+
+@celery_app.task(ignore_result=True)
+def rotate_api_log_partitions_task():
+    """Create upcoming api_logs partitions and drop expired ones (scheduled daily by beat)."""
+    rotate_api_log_partitions()
+
+
+def send_webhook_sync(webhook_url: str, payload: dict, on_delivered=None):
+    """
+    Queue a webhook notification; the calling task doesn't wait for its delivery.
+    on_delivered, if given, is called once the receiver has accepted it.
+    """
+    webhook_executor.submit(deliver_webhook_sync, webhook_url, payload, on_delivered)
+
+
+def deliver_webhook_sync(webhook_url: str, payload: dict, on_delivered=None):
+    if post_webhook_sync(webhook_url, payload) and on_delivered is not None:
+        try:
+            on_delivered()
+        except Exception as e:
+            # Nobody waits on the future, so this is the only place it shows up
+            logger.error(f"Failed to record webhook delivery to {webhook_url}: {e}")
+
+
+def post_webhook_sync(webhook_url: str, payload: dict) -> bool:
+    """
+    Send webhook notification over the pooled client. Returns True once delivered.
+    Connection errors, 429 and 5xx get a couple of quick retries.
+    """
+    for attempt in range(WEBHOOK_SYNC_ATTEMPTS):
+        try:
+            response = get_http_client().post(webhook_url, json=payload)
+            if response.status_code < 500 and response.status_code != 429:
+                response.raise_for_status()
+                logger.info(f"Webhook sent successfully to {webhook_url}")
+                return True
+            error = f"HTTP {response.status_code}"
+        except httpx.HTTPStatusError as e:
+            # Client errors won't succeed on retry
+            logger.error(f"Webhook rejected: {e}")
+            return False
+        except httpx.HTTPError as e:
+            error = str(e) or type(e).__name__
+        except Exception as e:
+            # Nobody waits on the future, so this is the only place it shows up
+            logger.error(f"Webhook to {webhook_url} failed: {e}")
+            return False
+
+        if attempt + 1 < WEBHOOK_SYNC_ATTEMPTS:
+            time.sleep(0.3 * 2 ** attempt)
+        else:
+            logger.error(f"Webhook failed after {WEBHOOK_SYNC_ATTEMPTS} attempts: {error}")
+    return False
@@ -0,0 +1,7 @@
+import os
+import sys
+from pathlib import Path
+
+# The modules live at the repo root; keep them off the real database
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DATABASE_URL", "sqlite:////tmp/cfdi-verifier-tests.db")
@@ -0,0 +1,59 @@
+import threading
+import time
+
+import tasks
+
+
+def run_chunks(monkeypatch, chunks, verify):
+    monkeypatch.setattr(tasks, "mark_chunk_processing", lambda *args: None)
+    monkeypatch.setattr(tasks, "save_chunk_results", lambda *args: None)
+    monkeypatch.setattr(tasks, "verify_folio", verify)
+
+    results = {}
+
+    def run(name, items):
+        results[name] = tasks.verify_folio_chunk_task.run(items, "batch", 0)
+
+    threads = [threading.Thread(target=run, args=chunk) for chunk in chunks.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_chunks_dont_queue_behind_each_other(monkeypatch):
+    monkeypatch.setattr(tasks, "BATCH_ITEM_CONCURRENCY", 2)
+    monkeypatch.setattr(tasks, "BATCH_CHUNK_TIMEOUT", 0.5)
+
+    def verify(folio, rfc_emisor, rfc_receptor, max_captcha_retries, deadline):
+        time.sleep(0.3)
+        return {"valid": True, "folio_fiscal": folio}
+
+    chunks = {
+        "a": [{"id": "A1", "re": "", "rr": ""}, {"id": "A2", "re": "", "rr": ""}],
+        "b": [{"id": "B1", "re": "", "rr": ""}, {"id": "B2", "re": "", "rr": ""}],
+    }
+    results = run_chunks(monkeypatch, chunks, verify)
+
+    assert [r["folio_fiscal"] for r in results["a"]] == ["A1", "A2"]
+    assert [r["folio_fiscal"] for r in results["b"]] == ["B1", "B2"]
+
+
+def test_items_stop_at_the_chunk_deadline(monkeypatch):
+    monkeypatch.setattr(tasks, "BATCH_ITEM_CONCURRENCY", 1)
+    monkeypatch.setattr(tasks, "BATCH_CHUNK_TIMEOUT", 0.2)
+    started = []
+
+    def verify(folio, rfc_emisor, rfc_receptor, max_captcha_retries, deadline):
+        started.append(folio)
+        time.sleep(0.3)
+        tasks.time_left(deadline)
+        return {"valid": True, "folio_fiscal": folio}
+
+    chunks = {"a": [{"id": "A1", "re": "", "rr": ""}, {"id": "A2", "re": "", "rr": ""}]}
+    results = run_chunks(monkeypatch, chunks, verify)
+
+    assert results["a"] == [{"error": "Chunk time limit exceeded"}] * 2
+    time.sleep(0.2)
+    assert started == ["A1"]
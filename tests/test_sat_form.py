@@ -0,0 +1,64 @@
+import functools
+
+import httpx
+import pytest
+
+import sat_form
+import tasks
+
+FORM_PAGE = """
+<html><body><form action="./" method="post">
+<input type="hidden" name="__VIEWSTATE" value="state" />
+<input type="hidden" name="__EVENTVALIDATION" value="validation" />
+<table>
+  <tr><td>Folio fiscal*</td><td><input name="ctl00$MainContent$TxtUUID" /></td></tr>
+  <tr><td>RFC emisor*</td><td><input name="ctl00$MainContent$TxtRfcEmisor" /></td></tr>
+  <tr><td colspan="2">{errors}</td></tr>
+</table>
+<img id="ctl00_MainContent_ImgCaptcha" src="Captcha.aspx?id=1" />
+</form></body></html>
+"""
+
+RESULT_PAGE = """
+<html><body><form action="./" method="post">
+<input type="hidden" name="__VIEWSTATE" value="state" />
+<table>
+  <tr><td>AAA010101AAA</td><td>Emisor SA</td><td>XAXX010101000</td><td>Receptor SA</td></tr>
+  <tr><td>Vigente</td></tr>
+</table>
+</form></body></html>
+"""
+
+
+def test_parse_result_reads_an_answer():
+    page_data = sat_form.parse_result(RESULT_PAGE)
+    assert page_data["vigente"]
+    assert sat_form.results_from_page(page_data)["rfc_emisor"] == "AAA010101AAA"
+
+
+def test_parse_result_rejects_a_re_rendered_form():
+    with pytest.raises(sat_form.SatFormError):
+        sat_form.parse_result(FORM_PAGE.format(errors="Campo requerido"))
+
+
+def test_re_rendered_form_falls_back_to_the_browser(monkeypatch):
+    posts = []
+
+    def sat(request):
+        if request.method == "POST":
+            posts.append(request)
+            return httpx.Response(200, text=FORM_PAGE.format(errors="Formato de folio no válido"))
+        if "Captcha" in request.url.path:
+            return httpx.Response(200, content=b"png")
+        return httpx.Response(200, text=FORM_PAGE.format(errors=""))
+
+    monkeypatch.setattr(tasks, "SAT_DIRECT_POST", True)
+    monkeypatch.setattr(tasks, "solve_captcha_sync", lambda image, timeout: "12345")
+    monkeypatch.setattr(
+        tasks.httpx, "Client", functools.partial(httpx.Client, transport=httpx.MockTransport(sat))
+    )
+    browser_result = {"valid": True, "message": "CFDI vigente - válido y activo"}
+    monkeypatch.setattr(tasks, "verify_on_sat_page", lambda *args, timeout: browser_result)
+
+    assert tasks.verify_folio("UUID", "AAA010101AAA", "XAXX010101000") is browser_result
+    assert len(posts) == 1
@@ -10,25 +10,33 @@ import sys
 from pathlib import Path
 
 from dotenv import load_dotenv
-from playwright.sync_api import sync_playwright
+from playwright.sync_api import TimeoutError as PlaywrightTimeoutError, sync_playwright
 from twocaptcha import TwoCaptcha
 
 # Load environment variables from .env file
 load_dotenv(Path(__file__).parent / ".env")
 
 
-def solve_captcha_with_2captcha(image_bytes: bytes) -> str:
-    """Use 2Captcha service to solve the CAPTCHA."""
-    api_key = os.getenv("TWOCAPTCHA_API_KEY")
-    if not api_key:
-        raise ValueError("TWOCAPTCHA_API_KEY not found in environment")
+_solver = None
+
 
-    solver = TwoCaptcha(api_key)
+def get_solver() -> TwoCaptcha:
+    """The 2Captcha client, created once and reused across CAPTCHA retries."""
+    global _solver
+    if _solver is None:
+        api_key = os.getenv("TWOCAPTCHA_API_KEY")
+        if not api_key:
+            raise ValueError("TWOCAPTCHA_API_KEY not found in environment")
+        _solver = TwoCaptcha(api_key)
+    return _solver
 
+
+def solve_captcha_with_2captcha(image_bytes: bytes) -> str:
+    """Use 2Captcha service to solve the CAPTCHA."""
     # Convert to base64
-    base64_image = base64.standard_b64encode(image_bytes).decode("utf-8")
+    base64_image = base64.b64encode(image_bytes).decode("ascii")
 
-    result = solver.normal(base64_image)
+    result = get_solver().normal(base64_image)
     return result["code"]
 
 
@@ -56,12 +64,11 @@ def verify_cfdi(xml_path: str, headless: bool = False, max_retries: int = 3) ->
             try:
                 # Navigate to SAT verification page
                 print(f"Attempt {attempt + 1}: Loading SAT verification page...")
-                page.goto("https://verificacfdi.facturaelectronica.sat.gob.mx/")
-                page.wait_for_load_state("networkidle")
+                page.goto("https://verificacfdi.facturaelectronica.sat.gob.mx/", wait_until="domcontentloaded")
 
                 # Select XML file consultation mode
                 page.get_by_role("radio", name="Consulta por archivo XML").click()
-                page.wait_for_timeout(500)
+                page.wait_for_selector("#ctl00_MainContent_ImgCaptchaXml", state="visible")
 
                 # Upload the XML file
                 print("Uploading XML file...")
@@ -70,10 +77,9 @@ def verify_cfdi(xml_path: str, headless: bool = False, max_retries: int = 3) ->
                 file_chooser = fc_info.value
                 file_chooser.set_files(str(xml_file))
 
-                page.wait_for_timeout(500)
-
                 # Get CAPTCHA image and solve it
                 print("Solving CAPTCHA with 2Captcha...")
+                page.wait_for_selector("#ctl00_MainContent_ImgCaptchaXml", state="visible")
                 captcha_img = page.locator("#ctl00_MainContent_ImgCaptchaXml")
                 captcha_bytes = captcha_img.screenshot()
 
@@ -86,7 +92,10 @@ def verify_cfdi(xml_path: str, headless: bool = False, max_retries: int = 3) ->
                 # Submit
                 print("Submitting verification request...")
                 page.get_by_role("button", name="Verificar CFDI").click()
-                page.wait_for_timeout(2000)
+                try:
+                    page.wait_for_selector("text=/CFDI válido|Vigente|Cancelado|incorrecto/i", timeout=15000)
+                except PlaywrightTimeoutError:
+                    pass  # No known marker, classify the page as it is
 
                 # Check for results or error
                 page_content = page.content()
@@ -116,6 +125,17 @@ def verify_cfdi(xml_path: str, headless: bool = False, max_retries: int = 3) ->
         raise Exception(f"Failed to verify CFDI after {max_retries} attempts")
 
 
+# Page text plus the cell texts (td and th) of the first two tables
+TABLES_JS = """() => ({
+    text: document.body.innerText,
+    tables: Array.from(document.querySelectorAll('table')).slice(0, 2).map((t, i) =>
+        Array.from(t.querySelectorAll('tr')).map(
+            r => Array.from(r.querySelectorAll(i === 0 ? 'td' : 'td, th')).map(c => c.innerText.trim())
+        )
+    ),
+})"""
+
+
 def extract_results(page) -> dict:
     """Extract verification results from the page."""
     results = {
@@ -125,45 +145,31 @@ def extract_results(page) -> dict:
     }
 
     try:
-        # Check for success message
-        if page.locator("text=CFDI válido").count() > 0:
-            results["valid"] = True
-            results["message"] = "CFDI válido almacenado en los controles del SAT"
-
-        # Extract table data
-        tables = page.locator("table")
-
-        # First table - XML Validation
-        validation_table = tables.nth(0)
-        rows = validation_table.locator("tr")
-
-        for i in range(rows.count()):
-            row = rows.nth(i)
-            cells = row.locator("td")
-            if cells.count() >= 2:
-                key = cells.nth(0).inner_text().strip()
-                value = cells.nth(1).inner_text().strip()
-                if key and value:
-                    results["details"][key] = value
-
-        # Second table - Additional details
-        if tables.count() > 1:
-            details_table = tables.nth(1)
-            rows = details_table.locator("tr")
-
-            for i in range(rows.count()):
-                row = rows.nth(i)
-                cells = row.locator("td, th")
-                texts = [cells.nth(j).inner_text().strip() for j in range(cells.count())]
-
-                # Parse key-value pairs
-                if len(texts) >= 2:
-                    for j in range(0, len(texts) - 1, 2):
-                        if texts[j] and texts[j+1] if j+1 < len(texts) else None:
-                            results["details"][texts[j]] = texts[j+1]
-
+        # Body text and the cells of the first two tables in one round trip
+        page_data = page.evaluate(TABLES_JS)
     except Exception as e:
         print(f"Warning: Error extracting results: {e}")
+        return results
+
+    # Check for success message
+    if "CFDI válido" in page_data["text"]:
+        results["valid"] = True
+        results["message"] = "CFDI válido almacenado en los controles del SAT"
+
+    tables = page_data["tables"]
+
+    # First table - XML Validation
+    for cells in tables[0] if tables else []:
+        if len(cells) >= 2:
+            key, value = cells[0], cells[1]
+            if key and value:
+                results["details"][key] = value
+
+    # Second table - Additional details, as key/value pairs
+    for texts in tables[1] if len(tables) > 1 else []:
+        for j in range(0, len(texts) - 1, 2):
+            if texts[j] and texts[j + 1]:
+                results["details"][texts[j]] = texts[j + 1]
 
     return results
 
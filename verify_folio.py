@@ -10,21 +10,30 @@ import sys
 from pathlib import Path
 
 from dotenv import load_dotenv
-from playwright.sync_api import sync_playwright
+from playwright.sync_api import TimeoutError as PlaywrightTimeoutError, sync_playwright
 from twocaptcha import TwoCaptcha
 
 load_dotenv(Path(__file__).parent / ".env")
 
 
+_solver = None
+
+
+def get_solver() -> TwoCaptcha:
+    """The 2Captcha client, created once and reused across CAPTCHA retries."""
+    global _solver
+    if _solver is None:
+        api_key = os.getenv("TWOCAPTCHA_API_KEY")
+        if not api_key:
+            raise ValueError("TWOCAPTCHA_API_KEY not set")
+        _solver = TwoCaptcha(api_key)
+    return _solver
+
+
 def solve_captcha(image_bytes: bytes) -> str:
     """Solve CAPTCHA using 2Captcha."""
-    api_key = os.getenv("TWOCAPTCHA_API_KEY")
-    if not api_key:
-        raise ValueError("TWOCAPTCHA_API_KEY not set")
-
-    solver = TwoCaptcha(api_key)
-    base64_image = base64.standard_b64encode(image_bytes).decode("utf-8")
-    result = solver.normal(base64_image)
+    base64_image = base64.b64encode(image_bytes).decode("ascii")
+    result = get_solver().normal(base64_image)
     return result["code"]
 
 
@@ -57,11 +66,10 @@ def verify_by_folio(
         for attempt in range(max_retries):
             try:
                 print(f"Attempt {attempt + 1}: Loading SAT verification page...")
-                page.goto("https://verificacfdi.facturaelectronica.sat.gob.mx/")
-                page.wait_for_load_state("networkidle")
+                page.goto("https://verificacfdi.facturaelectronica.sat.gob.mx/", wait_until="domcontentloaded")
 
                 # Already on "Consulta por Folio Fiscal" by default
-                page.wait_for_timeout(500)
+                page.wait_for_selector("#ctl00_MainContent_ImgCaptcha", state="visible")
 
                 # Fill in the form fields
                 print("Filling form data...")
@@ -82,7 +90,10 @@ def verify_by_folio(
                 # Submit
                 print("Submitting...")
                 page.get_by_role("button", name="Verificar CFDI").click()
-                page.wait_for_timeout(2000)
+                try:
+                    page.wait_for_selector("text=/CFDI válido|Vigente|Cancelado|incorrecto/i", timeout=15000)
+                except PlaywrightTimeoutError:
+                    pass  # No known marker, classify the page as it is
 
                 # Check results
                 page_content = page.content()
@@ -110,6 +121,27 @@ def verify_by_folio(
         raise Exception(f"Failed after {max_retries} attempts")
 
 
+# Page text plus every table's cell texts, grouped by table
+TABLES_JS = """() => ({
+    text: document.body.innerText,
+    tables: Array.from(document.querySelectorAll('table')).map(t =>
+        Array.from(t.querySelectorAll('tr')).map(
+            r => Array.from(r.querySelectorAll('td')).map(c => c.innerText.trim())
+        )
+    ),
+})"""
+
+
+# (lowercase label, result field) of the validation table rows
+VALIDATION_LABELS = (
+    ("folio fiscal", "folio_fiscal"),
+    ("rfc emisor", "rfc_emisor"),
+    ("rfc receptor", "rfc_receptor"),
+    ("sello cfdi", "sello_cfdi"),
+    ("sello del timbre fiscal", "sello_sat"),
+)
+
+
 def extract_results(page) -> dict:
     """Extract verification results."""
     results = {
@@ -129,60 +161,45 @@ def extract_results(page) -> dict:
     }
 
     try:
-        page_content = page.content()
-
-        # Check for valid CFDI indicators
-        if "CFDI válido" in page_content or "Vigente" in page_content:
-            results["valid"] = True
-            results["message"] = "CFDI válido almacenado en los controles del SAT"
-
-        # Extract validation table
-        for label, key in [
-            ("Folio Fiscal", "folio_fiscal"),
-            ("Rfc emisor", "rfc_emisor"),
-            ("Rfc receptor", "rfc_receptor"),
-            ("Sello CFDI", "sello_cfdi"),
-            ("Sello del timbre fiscal", "sello_sat"),
-        ]:
-            try:
-                row = page.locator(f"tr:has(td:has-text('{label}'))")
-                if row.count() > 0:
-                    cells = row.first.locator("td")
-                    if cells.count() >= 2:
-                        results[key] = cells.nth(1).inner_text().strip()
-            except Exception:
-                pass
-
-        # Extract emisor/receptor names
-        try:
-            table = page.locator("table").nth(1)
-            rows = table.locator("tr")
-            for i in range(rows.count()):
-                cells = rows.nth(i).locator("td")
-                if cells.count() >= 4:
-                    texts = [cells.nth(j).inner_text() for j in range(4)]
-                    if texts[0] and not texts[0].startswith("RFC"):
-                        results["rfc_emisor"] = texts[0].strip()
-                        results["nombre_emisor"] = texts[1].strip()
-                        results["rfc_receptor"] = texts[2].strip()
-                        results["nombre_receptor"] = texts[3].strip()
-                        break
-        except Exception:
-            pass
-
-        # Extract total and estado
-        try:
-            total_row = page.locator("tr:has(td:has-text('$'))")
-            if total_row.count() > 0:
-                cells = total_row.first.locator("td")
-                if cells.count() >= 4:
-                    results["total"] = cells.nth(0).inner_text().strip()
-                    results["estado"] = cells.nth(2).inner_text().strip()
-        except Exception:
-            pass
-
+        # Body text and every table's cell texts in one round trip
+        page_data = page.evaluate(TABLES_JS)
     except Exception:
-        pass
+        return results
+
+    # Check for valid CFDI indicators
+    if "CFDI válido" in page_data["text"] or "Vigente" in page_data["text"]:
+        results["valid"] = True
+        results["message"] = "CFDI válido almacenado en los controles del SAT"
+
+    tables = page_data["tables"]
+    rows = [cells for table in tables for cells in table]
+
+    # Extract validation table: one pass for all labels, each row lowercased once
+    pending = list(VALIDATION_LABELS)
+    for cells in rows:
+        lowered = [c.lower() for c in cells]
+        for label, key in list(pending):
+            if any(label in c for c in lowered):
+                pending.remove((label, key))
+                if len(cells) >= 2:
+                    results[key] = cells[1]
+        if not pending:
+            break
+
+    # Extract emisor/receptor names
+    for texts in tables[1] if len(tables) > 1 else []:
+        if len(texts) >= 4 and texts[0] and not texts[0].startswith("RFC"):
+            results["rfc_emisor"] = texts[0]
+            results["nombre_emisor"] = texts[1]
+            results["rfc_receptor"] = texts[2]
+            results["nombre_receptor"] = texts[3]
+            break
+
+    # Extract total and estado
+    cells = next((r for r in rows if any("$" in c for c in r)), None)
+    if cells and len(cells) >= 4:
+        results["total"] = cells[0]
+        results["estado"] = cells[2]
 
     return results
 